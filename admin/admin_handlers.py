@@ -18,9 +18,16 @@ from admin.admin_keyboard import admin_panel_menu, op_panel_button, cancel_op_pa
 from admin.admin_states import OpState, NameUrl, StartMessage, \
     UpdateLinkOp, ApiKeyStates, SetStartMessageDelay, Malling
 from admin.services import format_statistics_report
+from services.counters import CounterAggregator
+from services.generation_queue import GenerationQueue
+from services.providers import ProviderRouter
+from services.result_cache import ResultCache
+from services.usage import UsageRecorder
 
 from config import list_admins
 from database.database import Database
+from database.unit_of_work import commit_current_unit_of_work
+from data.constants import LEDGER_ADMIN
 
 
 admin_router = Router()
@@ -57,6 +64,8 @@ async def start_malling(clb: types.CallbackQuery, db: Database, state: FSMContex
     msg_id = state_data.get('msg_id')
     chat_id = state_data.get('chat_id')
     counter = 0
+    # Статус active обновляем в конце двумя запросами, а не по запросу на каждого пользователя
+    activated, deactivated = [], []
     for user in users:
         try:
             await clb.bot.copy_message(
@@ -65,10 +74,13 @@ async def start_malling(clb: types.CallbackQuery, db: Database, state: FSMContex
                 from_chat_id=chat_id
             )
             if not user.active:
-                await db.user.update_user(user.id, active=True)
+                activated.append(user.id)
             counter += 1
         except Exception:
-            await db.user.update_user(user.id, active=False)
+            if user.active:
+                deactivated.append(user.id)
+    await db.user.bulk_update_users(activated, active=True)
+    await db.user.bulk_update_users(deactivated, active=False)
     await message.delete()
     await clb.message.answer(f'Рассылка успешно завершена, сообщение получило {counter} пользователей из {len(users)}')
     await state.clear()
@@ -182,8 +194,10 @@ async def set_op_link_and_create_handler(message: types.Message, state: FSMConte
 
 
 @admin_router.message(F.text == 'Статистика')
-async def statistics_handler(message: types.Message, db: Database):
+async def statistics_handler(message: types.Message, db: Database, result_cache: ResultCache,
+                             generation_queue: GenerationQueue, counters: CounterAggregator):
     await message.answer("⏳ Собираю статистику...")
+    await counters.flush()
 
     stat_names = [
         'users', 'Kling v2.1 — видео текст+фото', 'Seedance 1 Lite — видео по тексту', 'Minimax - Видео по фото', 'Sora - Генерация изображений', 'Veo3 - видео сценарию', 'income'
@@ -191,7 +205,12 @@ async def statistics_handler(message: types.Message, db: Database):
     stats_data = await db.statistic.get_multiple_stats(stat_names)
     users = await db.user.get_users()
 
-    report_text = format_statistics_report(stats_data, users)
+    usage_stats = {
+        'daily': await db.usage.daily_totals(),
+        'top_users': await db.usage.top_users(),
+    }
+    report_text = format_statistics_report(stats_data, users, result_cache.stats(), generation_queue.wait_stats(),
+                                           usage_stats, db.user.cache.stats())
 
     await message.answer(report_text, parse_mode='HTML')
 
@@ -276,9 +295,12 @@ async def set_ad_url_name_handler(message: types.Message, state: FSMContext, db:
 
 
 @admin_router.callback_query(F.data.startswith('ad_url:'))
-async def ad_urls_action_handler(call: types.CallbackQuery, db: Database, state: FSMContext):
+async def ad_urls_action_handler(call: types.CallbackQuery, db: Database, state: FSMContext,
+                                 counters: CounterAggregator):
 
     await state.set_state()
+    # Дописываем накопленные счетчики: для просмотра — свежие цифры, для удаления — чтобы ссылка не воскресла
+    await counters.flush()
 
     try:
         _, action, *params = call.data.split(':')
@@ -335,9 +357,33 @@ async def send_logs_bot_func(message: types.Message):
 
 
 
+@admin_router.message(Command('providers'))
+async def providers_state_handler(message: types.Message, provider_router: ProviderRouter):
+    """Показывает состояние circuit breaker'ов провайдеров генерации."""
+    states = provider_router.states()
+    if not states:
+        return await message.answer(texts.PROVIDERS_STATE_EMPTY)
+
+    lines = [texts.PROVIDERS_STATE_HEADER]
+    for item in states:
+        lines.append(texts.BREAKER_STATE_LINE.format(
+            icon=texts.BREAKER_STATE_ICONS.get(item['state'], '⚪️'),
+            provider=item['provider'],
+            model=item['model'] or '(все модели)',
+            state=item['state'],
+            error_rate=item['error_rate'],
+            latency=f"{item['last_latency']} сек." if item['last_latency'] is not None else '—',
+        ))
+    await message.answer("\n".join(lines), parse_mode='HTML')
+
+
 @admin_router.message(Command('restart'))
-async def restart_bot(message: types.Message):
+async def restart_bot(message: types.Message, counters: CounterAggregator, usage_recorder: UsageRecorder):
     if message.from_user.id in list_admins:
+        # execl заменяет процесс без штатной остановки: сначала пишем все, что еще лежит в памяти
+        await counters.flush()
+        await usage_recorder.flush()
+        await commit_current_unit_of_work()
         os.execl(sys.executable, sys.executable, *sys.argv)
 
 
@@ -549,7 +595,7 @@ async def add_tokens_func(message: types.Message, db: Database):
     try:
         user_id = int(user_id)
         count = int(count)
-        await db.user.increase_value(user_id, 'generations', count)
+        await db.user.change_balance(user_id, count, LEDGER_ADMIN)
         await message.answer('Успешно!')
     except Exception as e:
         await message.answer('Произошла ошибка')
\ No newline at end of file
@@ -12,7 +12,9 @@ STATS_ICONS = {
 }
 
 
-def format_statistics_report(stats_data: dict, users: list) -> str:
+def format_statistics_report(stats_data: dict, users: list, cache_stats: dict | None = None,
+                             wait_stats: list[dict] | None = None, usage_stats: dict | None = None,
+                             user_cache_stats: dict | None = None) -> str:
     """
     Формирует большой текстовый отчет по статистике.
     """
@@ -46,5 +48,21 @@ def format_statistics_report(stats_data: dict, users: list) -> str:
         refs=refs,
         stats_block="\n".join(stats_blocks)
     )
+    if cache_stats is not None:
+        final_report += texts.RESULT_CACHE_STATS_TEMPLATE.format(**cache_stats)
+    if user_cache_stats is not None:
+        final_report += texts.USER_CACHE_STATS_TEMPLATE.format(**user_cache_stats)
+    if wait_stats:
+        final_report += texts.QUEUE_WAIT_HEADER + "\n".join(
+            texts.QUEUE_WAIT_LINE.format(**item) for item in wait_stats
+        ) + "\n"
+    if usage_stats and usage_stats['daily']:
+        final_report += texts.USAGE_DAILY_HEADER + "\n".join(
+            texts.USAGE_DAILY_LINE.format(**item) for item in usage_stats['daily']
+        ) + "\n"
+        if usage_stats['top_users']:
+            final_report += texts.USAGE_TOP_USERS_HEADER + "\n".join(
+                texts.USAGE_TOP_USER_LINE.format(**item) for item in usage_stats['top_users']
+            ) + "\n"
 
     return final_report
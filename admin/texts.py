@@ -22,6 +22,35 @@ STATS_BLOCK_TEMPLATE = """
 Использовано в прошлом месяце: {past_month}
 """
 
+RESULT_CACHE_STATS_TEMPLATE = """
+♻️<b>Кэш результатов:</b>
+Записей: {size}
+Попаданий: {hits}
+Промахов: {misses}
+Доля попаданий: {hit_rate}%
+"""
+
+USER_CACHE_STATS_TEMPLATE = """
+👤<b>Кэш пользователей:</b>
+Записей: {size}
+Попаданий: {hits}
+Промахов: {misses}
+Доля попаданий: {hit_rate}%
+"""
+
+QUEUE_WAIT_HEADER = "\n⏱<b>Ожидание в очереди генераций:</b>\n"
+QUEUE_WAIT_LINE = "{name}: задач {count}, в среднем {avg} сек, p95 {p95} сек"
+
+USAGE_DAILY_HEADER = "\n🧮<b>Токены OpenAI по дням:</b>\n"
+USAGE_DAILY_LINE = "{day}: запросов {requests}, промпт {prompt_tokens}, ответ {completion_tokens}"
+USAGE_TOP_USERS_HEADER = "\n👤<b>Больше всего токенов за 30 дней:</b>\n"
+USAGE_TOP_USER_LINE = "<code>{user_id}</code>: запросов {requests}, токенов {tokens}"
+
+PROVIDERS_STATE_HEADER = "<b>Провайдеры генерации:</b>"
+PROVIDERS_STATE_EMPTY = "Запросов к провайдерам еще не было."
+BREAKER_STATE_ICONS = {'closed': '🟢', 'half_open': '🟡', 'open': '🔴'}
+BREAKER_STATE_LINE = "{icon} <b>{provider}</b> {model}: {state}, ошибок {error_rate}%, последняя генерация {latency}"
+
 
 AD_URL_STATS_TEMPLATE = """
 Реферальная ссылка: <b>{name}</b>
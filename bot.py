@@ -1,5 +1,6 @@
 # bot.py
 import asyncio
+import functools
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
@@ -12,7 +13,20 @@ from admin.admin_handlers import admin_router
 from database.database import Database
 from database.engine import engine, async_session_factory
 from database.models import Base
+from database.unit_of_work import UnitOfWorkMiddleware, UnitOfWorkRequestMiddleware
 from handlers.user_handlers import user_router
+from services.counters import CounterAggregator
+from services.generation_queue import GenerationQueue
+from services.http_client import HTTPClientPool
+from services.nexus_poller import NexusTaskPoller
+from services.providers import ProviderRouter, NexusProvider, ReplicateProvider
+from services.replicate_webhook import ReplicateWebhookReceiver
+from services.result_cache import ResultCache
+from services.upload_cache import UploadCache
+from services.dialog_store import DialogStore
+from services.usage import UsageRecorder
+from utils.chat_gpt import summarize_dialog
+from data.constants import HTTP_WARMUP_ON_STARTUP
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
@@ -52,6 +66,44 @@ async def main():
     dp['db'] = db_instance
     dp['key_manager'] = key_manager
     dp['bot'] = bot
+    # Общий пул HTTP-соединений ко всем внешним API
+    http = HTTPClientPool()
+    dp['http'] = http
+    nexus_poller = NexusTaskPoller(http)
+
+    # Необязательный режим вебхуков Replicate: включается, если в конфиге задан публичный URL и секрет
+    replicate_webhook = None
+    webhook_url = getattr(config, 'REPLICATE_WEBHOOK_URL', None)
+    webhook_secret = getattr(config, 'REPLICATE_WEBHOOK_SECRET', None)
+    if webhook_url and webhook_secret:
+        replicate_webhook = ReplicateWebhookReceiver(
+            webhook_url, webhook_secret, port=getattr(config, 'REPLICATE_WEBHOOK_PORT', 8080)
+        )
+    dp['replicate_webhook'] = replicate_webhook
+
+    # NexusAPI — основной провайдер, Replicate — запасной на время, пока breaker Nexus разомкнут
+    provider_router = ProviderRouter([
+        NexusProvider(http, nexus_poller),
+        ReplicateProvider(http, key_manager, replicate_webhook),
+    ])
+    dp['provider_router'] = provider_router
+    result_cache = ResultCache()
+    dp['result_cache'] = result_cache
+    upload_cache = UploadCache(db_instance)
+    dp['upload_cache'] = upload_cache
+    usage_recorder = UsageRecorder(db_instance)
+    dp['usage_recorder'] = usage_recorder
+    counters = CounterAggregator(db_instance)
+    dp['counters'] = counters
+    generation_queue = GenerationQueue(bot, db_instance, http, provider_router, result_cache, counters,
+                                       usage_recorder)
+    dp['generation_queue'] = generation_queue
+    dp['dialog_store'] = DialogStore(db_instance, functools.partial(summarize_dialog, usage=usage_recorder))
+
+    # Одна сессия БД на апдейт: записи хендлера фиксируются вместе в конце его обработки
+    dp.update.outer_middleware(UnitOfWorkMiddleware(async_session_factory))
+    # Перед каждым запросом к Bot API записи апдейта фиксируются, транзакция не ждет ответа Telegram
+    bot.session.middleware(UnitOfWorkRequestMiddleware())
 
     # Регистрация роутеров
     dp.include_router(admin_router)
@@ -59,6 +111,15 @@ async def main():
 
     # Выполнение задач при старте
     await on_startup(bot)
+    if HTTP_WARMUP_ON_STARTUP:
+        await http.warmup()
+    # Воркеры стартуют после создания таблиц и сразу подхватывают незавершенные задачи
+    await nexus_poller.start()
+    if replicate_webhook:
+        await replicate_webhook.start()
+    await generation_queue.start()
+    await usage_recorder.start()
+    await counters.start()
 
     logging.info("Запуск бота...")
     try:
@@ -68,6 +129,13 @@ async def main():
     except Exception as e:
         logging.critical(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
     finally:
+        await generation_queue.stop()
+        await usage_recorder.stop()
+        await counters.stop()
+        await nexus_poller.stop()
+        if replicate_webhook:
+            await replicate_webhook.stop()
+        await http.close()
         await bot.session.close()
 
 
@@ -10,6 +10,14 @@ MODELS = {
     # "Luma Ray-2": "luma/ray-2-720p",
 }
 
+# Те же модели на Replicate — запасной провайдер, когда NexusAPI недоступен
+REPLICATE_MODELS = {
+    "Veo3 - видео сценарию": "google/veo-3",
+    "Kling v2.1 — видео текст+фото": "kwaivgi/kling-v2.1-master",
+    "Seedance 1 Lite — видео по тексту": "bytedance/seedance-1-lite",
+    "Minimax - Видео по фото": "minimax/video-01",
+}
+
 MODELS_EXAMPLE_OBJECT = {
     "Veo3 - видео сценарию": {
         'name': '<b>Veo3</b>',
@@ -111,6 +119,17 @@ MODEL_IMAGE_FIELD = {
     # "Luma Ray-2": "image",
 }
 
+# Подготовка фото-референсов перед загрузкой: больше этого разрешения модели все равно не используют.
+# crop — обрезать ли фото под выбранное пользователем соотношение сторон (у модели есть выбор формата)
+MODEL_IMAGE_LIMITS = {
+    "Veo3 - видео сценарию": {'max_side': 1920, 'format': 'JPEG', 'quality': 90, 'crop': False},
+    "Kling v2.1 — видео текст+фото": {'max_side': 1920, 'format': 'JPEG', 'quality': 90, 'crop': True},
+    "Minimax - Видео по фото": {'max_side': 1280, 'format': 'JPEG', 'quality': 88, 'crop': False},
+    "Seedance 1 Lite — видео по тексту": {'max_side': 1920, 'format': 'JPEG', 'quality': 90, 'crop': True},
+    'Sora - Генерация изображений': {'max_side': 1536, 'format': 'WEBP', 'quality': 90, 'crop': False},
+}
+DEFAULT_IMAGE_LIMITS = {'max_side': 1920, 'format': 'JPEG', 'quality': 90, 'crop': False}
+
 MODEL_DURATIONS = {
     # "Veo3": ["3 сек", "5 сек", "10 сек"],
     # "Pixverse v4.5": ["5 сек", "8 сек"],
@@ -153,3 +172,152 @@ DEFAULT_GENERATIONS = 0
 IMAGE_GPT_COST = 40
 
 VEO_COST = 200
+
+# Архивный канал, куда копируются готовые изображения
+ARCHIVE_CHAT_ID = -1002858090617
+
+# --- Очередь генераций ---
+GENERATION_QUEUE_POLL_INTERVAL = 5  # Как часто диспетчер очереди заглядывает в БД, если его не разбудили, сек.
+GENERATION_JOB_MAX_ATTEMPTS = 3  # После стольких перезапусков задача считается проваленной
+
+JOB_STATUS_PENDING = 'pending'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_DELIVERING = 'delivering'  # Результат получен и отправляется пользователю, отменить уже нельзя
+JOB_STATUS_COMPLETED = 'completed'
+JOB_STATUS_FAILED = 'failed'
+JOB_STATUS_CANCELED = 'canceled'
+
+# --- Общий HTTP-пул для внешних API ---
+HTTP_CONNECTIONS_LIMIT = 200  # Всего открытых соединений
+HTTP_CONNECTIONS_PER_HOST = 50  # Соединений на один хост
+HTTP_KEEPALIVE_TIMEOUT = 60  # Сколько держать простаивающее соединение, сек.
+HTTP_DNS_CACHE_TTL = 600  # Сколько кэшировать DNS-ответы, сек.
+HTTP_WARMUP_ON_STARTUP = True  # Открыть соединения к провайдерам заранее, при старте бота
+
+# Таймауты (total, connect) для каждого провайдера, сек.
+HTTP_PROVIDER_TIMEOUTS = {
+    'nexus': (60, 10),
+    'replicate': (60, 10),
+    'imgbb': (60, 10),
+    'telegram': (30, 10),
+}
+
+HTTP_WARMUP_URLS = {
+    'nexus': 'https://nexusapi.dev',
+    'replicate': 'https://api.replicate.com',
+    'imgbb': 'https://api.imgbb.com',
+    'telegram': 'https://api.telegram.org',
+}
+
+# --- Общий опрос статусов задач NexusAPI ---
+# Для каждой модели: (первая проверка через, базовый интервал, максимальный интервал), сек.
+# Veo считает заметно дольше Seedance, поэтому его опрашиваем реже.
+NEXUS_POLL_INTERVALS = {
+    'veo-3-quality': (60, 15, 30),
+    'kling-v2.1-master': (40, 10, 30),
+    'minimax-video-01': (40, 10, 30),
+    'seedance-1-lite': (15, 5, 15),
+    'gpt-4o-image': (15, 5, 15),
+}
+NEXUS_POLL_DEFAULT_INTERVAL = (20, 10, 30)
+NEXUS_POLL_BACKOFF = 0.02  # На сколько растет интервал за каждую секунду жизни задачи
+NEXUS_POLL_TIMEOUT = 1200  # Через сколько секунд задача считается зависшей
+NEXUS_POLL_CONCURRENCY = 20  # Сколько запросов статуса выполняется одновременно
+
+# --- Вебхуки Replicate ---
+REPLICATE_WEBHOOK_PATH = '/replicate/webhook'
+REPLICATE_WEBHOOK_DEADLINE = 600  # Сколько ждать вебхук, прежде чем перейти на опрос статуса, сек.
+REPLICATE_WEBHOOK_TOLERANCE = 300  # Допустимое расхождение времени подписи вебхука, сек.
+
+# --- Ограничение одновременных генераций по моделям ---
+MODEL_CONCURRENCY_LIMITS = {
+    'Sora - Генерация изображений': 6,
+    "Veo3 - видео сценарию": 3,
+    "Kling v2.1 — видео текст+фото": 4,
+    "Seedance 1 Lite — видео по тексту": 6,
+    "Minimax - Видео по фото": 4,
+}
+DEFAULT_MODEL_CONCURRENCY = 3
+# Воркер держит задачу всю генерацию, поэтому воркеров столько, сколько всего слотов у моделей:
+# одновременность ограничивают только лимиты моделей
+GENERATION_WORKERS = sum(MODEL_CONCURRENCY_LIMITS.get(model_key, DEFAULT_MODEL_CONCURRENCY) for model_key in MODELS)
+GENERATION_QUEUE_MAX_DEPTH = 50  # Сколько задач одной модели может ждать в очереди, дальше новые отклоняются
+
+# --- Приоритеты очереди генераций (чем больше, тем раньше задача попадет к воркеру) ---
+JOB_PRIORITY_FREE = 0  # Бесплатная ежедневная генерация
+JOB_PRIORITY_PAID = 1  # Обычная платная генерация
+JOB_PRIORITY_RECENT_PAYER = 2  # Пользователь недавно пополнял баланс
+JOB_PRIORITY_UNLIM = 3  # Безлимит
+JOB_PRIORITY_NAMES = {
+    JOB_PRIORITY_FREE: 'Бесплатные',
+    JOB_PRIORITY_PAID: 'Платные',
+    JOB_PRIORITY_RECENT_PAYER: 'Недавно оплатившие',
+    JOB_PRIORITY_UNLIM: 'Безлимит',
+}
+JOB_PRIORITY_AGING_SECONDS = 120  # Каждые N секунд ожидания поднимают задачу на один класс, чтобы она не ждала вечно
+RECENT_PAYMENT_WINDOW = 3 * 24 * 3600  # Сколько секунд после оплаты пользователь считается недавно оплатившим
+JOB_WAIT_SAMPLES = 500  # Сколько последних ожиданий в очереди хранить на класс для метрик
+
+# --- Загрузка фото-референсов из альбома ---
+IMAGE_UPLOAD_CONCURRENCY = 4  # Сколько фото одного альбома скачивается и загружается на ImgBB одновременно
+IMAGE_UPLOAD_TIMEOUT = 60  # Сколько секунд ждать скачивания и загрузки одного фото
+IMAGE_SPOOL_MAX_MEMORY = 5 * 1024 * 1024  # Фото до этого размера обрабатываются в памяти, крупнее — во временном файле
+
+# --- Кэш уже загруженных на ImgBB фото ---
+IMGBB_UPLOAD_URL = 'https://api.imgbb.com/1/upload'
+IMGBB_EXPIRATION = 30 * 24 * 3600  # Через сколько секунд ImgBB удаляет загруженное фото
+UPLOAD_CACHE_TTL = IMGBB_EXPIRATION - 24 * 3600  # С запасом, чтобы не отдать ссылку, которая вот-вот истечет
+UPLOAD_CACHE_SIZE = 5000  # Сколько записей держать в памяти, остальные читаются из БД
+
+# --- Кэш результатов одинаковых генераций ---
+RESULT_CACHE_SIZE = 1000  # Сколько результатов держать в памяти
+RESULT_CACHE_TTL = 24 * 3600  # Ссылки провайдеров живут около суток, сек.
+
+# --- Кэш пользователей (database/user_cache.py) ---
+USER_CACHE_SIZE = 10000  # Сколько снимков пользователей держать в памяти
+USER_CACHE_TTL = 60  # Сек. Страховка на случай записи в users в обход UserRepository
+
+# --- Circuit breaker провайдеров генерации ---
+BREAKER_WINDOW = 20  # По скольким последним вызовам считается доля ошибок
+BREAKER_MIN_CALLS = 5  # Меньше вызовов — недостаточно данных, чтобы размыкать
+BREAKER_FAILURE_RATE = 0.5  # Доля ошибок и медленных вызовов, при которой breaker размыкается
+BREAKER_OPEN_SECONDS = 120  # Сколько breaker остается разомкнутым до пробного вызова
+BREAKER_SLOW_CALL_SECONDS = 900  # Генерация дольше этого считается неудачной при подсчете доли
+
+# --- Ограничение частоты запросов пользователя (token bucket) ---
+# Тип события: (сколько токенов восстанавливается в секунду, емкость корзины — допустимая серия подряд)
+THROTTLE_RATES = {
+    'message': (1.0, 5),
+    'callback': (2.0, 6),
+    'submit': (0.1, 2),  # Отправка промпта на генерацию
+}
+THROTTLE_MAX_BUCKETS = 10000  # Сколько корзин держать в памяти, давно неактивные вытесняются
+
+# --- Диалог с GPT ---
+GPT_CHAT_MODEL = 'gpt-4.1-mini'
+GPT_HISTORY_TOKEN_BUDGET = 6000  # Примерный объем истории в токенах, больше — старые сообщения сворачиваются в краткое содержание
+GPT_HISTORY_KEEP_MESSAGES = 6  # Сколько последних сообщений всегда остаются в истории дословно
+GPT_DIALOG_CACHE_SIZE = 2000  # Сколько диалогов держать в памяти
+GPT_STREAM_ANSWERS = True  # Показывать ответ по мере генерации, а не целиком в конце
+GPT_STREAM_EDIT_INTERVAL = 1.2  # Не чаще одного редактирования сообщения за столько секунд (лимиты Telegram)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# --- Учет расхода токенов OpenAI ---
+USAGE_BUFFER_SIZE = 10000  # Сколько событий держать в памяти до записи, при переполнении старые теряются
+USAGE_FLUSH_INTERVAL = 30  # Как часто записывать накопленные события в БД, сек.
+
+# --- Журнал баланса (balance_ledger.reason) ---
+LEDGER_DEBIT = 'debit'  # Списание за генерацию
+LEDGER_REFUND = 'refund'  # Возврат за несостоявшуюся генерацию
+LEDGER_PURCHASE = 'purchase'  # Пополнение баланса
+LEDGER_REFERRAL_BONUS = 'referral_bonus'  # Бонус пригласившему
+LEDGER_ADMIN = 'admin'  # Начисление администратором
+LEDGER_UNLIM_EXPIRED = 'unlim_expired'  # Списание остатка после окончания безлимита
+
+# --- Платежные системы (payments.provider) ---
+PAYMENT_PROVIDER_YOOKASSA = 'yookassa'
+PAYMENT_PROVIDER_STARS = 'telegram_stars'
+UNLIM_BONUS_GENERATIONS = 50  # Сколько 💎 начисляется вместе с безлимитом
+
+# --- Счетчики статистики (services/counters.py) ---
+COUNTER_FLUSH_INTERVAL = 10  # Раз во сколько секунд накопленные счетчики Statistic/AdUrl пишутся в БД
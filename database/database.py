@@ -1,6 +1,10 @@
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from .repository import UserRepository,AdUrlRepository, SubscriptionRepository, StatisticsRepository, StartMessageRepository
+from .repository import UserRepository,AdUrlRepository, SubscriptionRepository, StatisticsRepository, StartMessageRepository, \
+    GenerationJobRepository, ImageUploadRepository, GptDialogRepository, \
+    UsageRepository, PaymentRepository
+from .unit_of_work import UnitOfWorkSessionFactory
+from .user_cache import UserCache
 
 class Database:
     """
@@ -8,9 +12,18 @@ class Database:
     Предоставляет единую точку доступа к данным: db.user, db.promocode и т.д.
     """
     def __init__(self, session_factory: async_sessionmaker):
+        # Внутри апдейта Telegram репозитории работают в общей сессии UnitOfWork, вне его — как раньше
+        session_factory = UnitOfWorkSessionFactory(session_factory)
         # Создаем экземпляры всех наших репозиториев
-        self.user = UserRepository(session_factory)
+        # Кэш пользователей общий: в users пишет не только UserRepository, но и зачисление платежей
+        self.user_cache = UserCache()
+        self.user = UserRepository(session_factory, self.user_cache)
         self.ad_url = AdUrlRepository(session_factory)
         self.subscription = SubscriptionRepository(session_factory)
         self.statistic = StatisticsRepository(session_factory)
-        self.start_message = StartMessageRepository(session_factory)
\ No newline at end of file
+        self.start_message = StartMessageRepository(session_factory)
+        self.generation_job = GenerationJobRepository(session_factory)
+        self.image_upload = ImageUploadRepository(session_factory)
+        self.gpt_dialog = GptDialogRepository(session_factory)
+        self.usage = UsageRepository(session_factory)
+        self.payment = PaymentRepository(session_factory, self.user_cache)
\ No newline at end of file
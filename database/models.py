@@ -90,3 +90,119 @@ class StartMessage(Base):
     def __repr__(self):
         return f"<StartMessage(id={self.id}, chat_id={self.chat_id}, message_id={self.message_id})>"
 
+
+
+class GenerationJob(Base):
+    """
+    Задача генерации в очереди. Переживает рестарт бота: незавершенные задачи
+    подхватываются воркерами заново при старте.
+    """
+    __tablename__ = 'generation_jobs'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    model_key: Mapped[str] = mapped_column(String(255), nullable=False)
+    prompt: Mapped[str] = mapped_column(Text, nullable=False)
+    params: Mapped[str] = mapped_column(Text, nullable=False)  # JSON с параметрами для API
+    image_urls: Mapped[str | None] = mapped_column(Text)  # JSON-список ссылок на фото-референсы
+    cost: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    status: Mapped[str] = mapped_column(String(32), nullable=False, server_default='pending', index=True)
+    status_message_id: Mapped[int | None] = mapped_column(BigInteger)
+    provider: Mapped[str | None] = mapped_column(String(32))  # Провайдер, которому отправлена задача
+    task_id: Mapped[str | None] = mapped_column(String(255))  # ID задачи у провайдера, чтобы не запускать ее повторно
+    provider_key: Mapped[str | None] = mapped_column(String(255))  # Ключ API, которым создана задача у провайдера
+    cache_key: Mapped[str | None] = mapped_column(String(64))  # Хэш параметров для кэша результатов
+    priority: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')  # Класс приоритета JOB_PRIORITY_*
+    debit_entry_id: Mapped[int | None] = mapped_column(BigInteger)  # Запись balance_ledger о списании за задачу
+    result: Mapped[str | None] = mapped_column(Text)  # JSON-список ссылок на результат
+    error: Mapped[str | None] = mapped_column(Text)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now())
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now(),
+                                                 onupdate=func.now())
+
+    def __repr__(self):
+        return f"<GenerationJob(id={self.id}, user_id={self.user_id}, status='{self.status}')>"
+
+
+class ImageUpload(Base):
+    """
+    Фото, уже загруженные на ImgBB. Ключ — file_unique_id из Telegram вместе с профилем подготовки
+    (`file:...`) или хэш содержимого (`sha256:...`), чтобы одно и то же фото не загружать повторно.
+    """
+    __tablename__ = 'image_uploads'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    url: Mapped[str] = mapped_column(Text, nullable=False)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<ImageUpload(key='{self.key}', url='{self.url}')>"
+
+
+class GptDialog(Base):
+    """История диалога пользователя с GPT: краткое содержание старой части и последние сообщения."""
+    __tablename__ = 'gpt_dialogs'
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    summary: Mapped[str | None] = mapped_column(Text)
+    messages: Mapped[str] = mapped_column(Text, nullable=False, server_default='[]')  # JSON-список {role, content}
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now(),
+                                                 onupdate=func.now())
+
+    def __repr__(self):
+        return f"<GptDialog(user_id={self.user_id})>"
+
+
+class UsageEvent(Base):
+    """Расход токенов OpenAI на один запрос: диалог с GPT или генерация изображения."""
+    __tablename__ = 'usage_events'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    model: Mapped[str] = mapped_column(String(64), nullable=False)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    completion_tokens: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    latency_ms: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now(), index=True)
+
+    def __repr__(self):
+        return f"<UsageEvent(user_id={self.user_id}, model='{self.model}')>"
+
+
+class BalanceLedger(Base):
+    """
+    Журнал движений баланса 💎: списания, возвраты, покупки, бонусы. Записи только добавляются.
+    Возврат ссылается на списание, которое он компенсирует, реферальный бонус — на покупку.
+    """
+    __tablename__ = 'balance_ledger'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    delta: Mapped[int] = mapped_column(Integer, nullable=False)
+    reason: Mapped[str] = mapped_column(String(32), nullable=False)  # LEDGER_*
+    ref_entry_id: Mapped[int | None] = mapped_column(BigInteger)  # Запись, к которой относится эта
+    payment_id: Mapped[str | None] = mapped_column(String(128))  # ID платежа у платежной системы
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<BalanceLedger(id={self.id}, user_id={self.user_id}, delta={self.delta}, reason='{self.reason}')>"
+
+
+class Payment(Base):
+    """Зачтенный платеж. Уникальный ID платежа не дает зачислить один и тот же платеж дважды."""
+    __tablename__ = 'payments'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    provider: Mapped[str] = mapped_column(String(32), nullable=False)  # PAYMENT_PROVIDER_*
+    provider_payment_id: Mapped[str] = mapped_column(String(128), nullable=False, unique=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    generations: Mapped[int] = mapped_column(Integer, nullable=False)  # Сколько 💎 начислено
+    price: Mapped[int] = mapped_column(Integer, nullable=False, server_default='0')  # Сумма в рублях, если оплата в рублях
+    is_unlim: Mapped[bool] = mapped_column(Boolean, nullable=False, server_default='0')
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<Payment(id={self.id}, provider='{self.provider}', user_id={self.user_id})>"
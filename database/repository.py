@@ -3,38 +3,55 @@ import os
 from datetime import datetime, timedelta
 from typing import Optional, Any, List, Sequence, Type, Dict
 
-from sqlalchemy import select, update, delete, func, and_, text
-from sqlalchemy.dialects.mysql import insert
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy import select, update, delete, func, and_, or_, literal, values, column, BigInteger, \
+    Integer, String
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import aliased
 
-from .models import User, StartMessage, AdUrl, SubscriptionCheck, Statistic
+from data.constants import JOB_STATUS_PENDING, JOB_STATUS_RUNNING, JOB_STATUS_DELIVERING, JOB_STATUS_CANCELED, JOB_PRIORITY_AGING_SECONDS, \
+    LEDGER_DEBIT, LEDGER_REFUND, LEDGER_UNLIM_EXPIRED, LEDGER_PURCHASE, LEDGER_REFERRAL_BONUS
+from .unit_of_work import immediate_session, independent_session
+from .user_cache import UserCache, UserSnapshot, USER_SNAPSHOT_FIELDS
+from .models import User, StartMessage, AdUrl, SubscriptionCheck, Statistic, GenerationJob, ImageUpload, \
+    GptDialog, UsageEvent, BalanceLedger, Payment
 
 
 class UserRepository:
+    """
+    Чтение пользователя идет через UserCache и возвращает неизменяемый UserSnapshot.
+    Все методы, которые пишут в users, после записи сбрасывают кэш затронутых пользователей.
+    """
 
-    def __init__(self, session_factory):
+    def __init__(self, session_factory, cache: UserCache | None = None):
         self.session_factory = session_factory
+        self.cache = cache or UserCache()
 
 
     async def get_or_create_user(self, user_id: int, username: str | None, ad_url: str | None = None, ref_id: str | None = None) -> \
-            tuple[Type[User], bool] | tuple[User, bool]:
+            tuple[UserSnapshot, bool]:
+
+        user = await self.get_user(user_id)
+        if user:
+            return user, False # Пользователь уже существует
 
         async with self.session_factory() as session:
-            user = await session.get(User, user_id)
-            if user:
-                return user, False # Пользователь уже существует
 
-            # Пользователя нет, создаем нового
-            new_user = User(
+            # Пользователя нет, создаем нового. ON CONFLICT спасает от двойного /start, пришедшего одновременно
+            stmt = insert(User).values(
                 id=user_id,
                 username=username,
                 ad_url=ad_url,
                 ref_id=ref_id
-            )
-            session.add(new_user)
+            ).on_conflict_do_nothing(index_elements=[User.id]).returning(User)
+            new_user = (await session.execute(stmt)).scalar_one_or_none()
             await session.commit()
-            await session.refresh(new_user)
-            return new_user, True
+        self.cache.invalidate(user_id)
+        if new_user is None:
+            return await self.get_user(user_id), False
+        snapshot = UserSnapshot.from_user(new_user)
+        self.cache.put(snapshot)
+        return snapshot, True
 
 
     async def create_user(self, user_id: int, username: str, ref_id: Optional[int] = None, ad_url: Optional[str] = None) -> bool:
@@ -44,18 +61,27 @@ class UserRepository:
             username=username,
             ref_id=ref_id,
             ad_url=ad_url
-        ).on_duplicate_key_update(id=User.id)
+        ).on_conflict_do_nothing(index_elements=[User.id])
 
         async with self.session_factory() as session:
             result = await session.execute(stmt)
             await session.commit()
-            return result.rowcount > 0
+        self.cache.invalidate(user_id)
+        return result.rowcount > 0
 
-    async def get_user(self, user_id: int) -> Optional[User]:
+    async def get_user(self, user_id: int) -> Optional[UserSnapshot]:
+        snapshot = self.cache.get(user_id)
+        if snapshot is not None:
+            return snapshot
 
+        version = self.cache.version
         async with self.session_factory() as session:
             user = await session.get(User, user_id)
-            return user
+            if user is None:
+                return None
+            snapshot = UserSnapshot.from_user(user)
+        self.cache.put(snapshot, version)
+        return snapshot
 
     async def get_users(self, **kwargs) -> Sequence[User]:
         async with self.session_factory() as session:
@@ -69,6 +95,7 @@ class UserRepository:
         async with self.session_factory() as session:
             await session.execute(stmt)
             await session.commit()
+        self.cache.invalidate(user_id)
 
     async def increase_value(self, user_id: int, column: str, amount: int = 1) -> None:
 
@@ -82,6 +109,40 @@ class UserRepository:
         async with self.session_factory() as session:
             await session.execute(stmt)
             await session.commit()
+        self.cache.invalidate(user_id)
+
+    async def bulk_update_users(self, user_ids: Sequence[int], **kwargs: Any) -> int:
+        """Обновляет одни и те же поля у многих пользователей одним запросом. Возвращает число обновленных."""
+        if not user_ids or not kwargs:
+            return 0
+        stmt = update(User).where(User.id.in_(user_ids)).values(**kwargs)
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+        self.cache.invalidate(*user_ids)
+        return result.rowcount
+
+    async def bulk_increase_value(self, column_name: str, amounts: Dict[int, int]) -> int:
+        """
+        Увеличивает колонку у многих пользователей одним запросом, у каждого на свою величину.
+        Пример: await db.user.bulk_increase_value('ref_count', {123: 1, 456: 2})
+        """
+        if not hasattr(User, column_name):
+            raise ValueError(f"Колонка '{column_name}' не найдена в модели User.")
+        if not amounts:
+            return 0
+
+        deltas = values(column('id', BigInteger), column('amount', Integer), name='deltas').data(
+            list(amounts.items())
+        )
+        stmt = update(User).where(User.id == deltas.c.id).values({
+            column_name: getattr(User, column_name) + deltas.c.amount
+        })
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+        self.cache.invalidate(*amounts)
+        return result.rowcount
 
     async def grant_unlim_access(self, user_id: int) -> None:
         await self.update_user(user_id, is_unlim=True, unlim_time=datetime.now())
@@ -120,35 +181,73 @@ class UserRepository:
 
 
     async def get_user_value(self, user_id: int, column_name: str) -> Any:
+        if column_name in USER_SNAPSHOT_FIELDS:
+            user = await self.get_user(user_id)
+            return getattr(user, column_name) if user else None
 
         async with self.session_factory() as session:
             query = select(getattr(User, column_name)).where(User.id == user_id)
             result = await session.execute(query)
             return result.scalar_one_or_none()
 
-    async def process_generation(self, user_id: int, cost: int) -> bool:
-        async with self.session_factory() as session:
-            user = await session.get(User, user_id)
-
+    async def change_balance(self, user_id: int, delta: int, reason: str, ref_entry_id: int | None = None,
+                             payment_id: str | None = None, completed_delta: int = 0,
+                             require_funds: bool = False) -> int | None:
+        """
+        Меняет баланс и пишет запись в balance_ledger одним запросом (UPDATE ... RETURNING внутри INSERT).
+        С require_funds баланс меняется, только если после изменения он не уйдет в минус, —
+        проверка делается в самом UPDATE, поэтому параллельные списания не могут пройти оба.
+        Возвращает id записи журнала или None, если баланс не изменился.
+        """
+        filters = [User.id == user_id]
+        if require_funds:
+            filters.append(User.generations + delta >= 0)
+        changes = {'generations': User.generations + delta}
+        if completed_delta:
+            changes['completed'] = User.completed + completed_delta
+        changed = update(User).where(*filters).values(changes).returning(User.id).cte('changed')
+
+        ledger = BalanceLedger.__table__
+        stmt = ledger.insert().from_select(
+            ['user_id', 'delta', 'reason', 'ref_entry_id', 'payment_id'],
+            select(changed.c.id, literal(delta), literal(reason),
+                   literal(ref_entry_id, BigInteger), literal(payment_id, String))
+        ).returning(ledger.c.id)
+        # Движение 💎 фиксируется сразу, не дожидаясь конца апдейта
+        async with immediate_session(self.session_factory) as session:
+            result = await session.execute(stmt)
+            entry_id = result.scalar_one_or_none()
+            await session.commit()
+        self.cache.invalidate(user_id)
+        return entry_id
 
-            if not user or user.generations < cost:
-                return False
+    async def process_generation(self, user_id: int, cost: int) -> int | None:
+        """Списывает стоимость генерации. Возвращает id записи о списании или None, если 💎 не хватает."""
+        return await self.change_balance(user_id, -cost, LEDGER_DEBIT, completed_delta=1, require_funds=True)
 
+    async def refund_generation(self, user_id: int, cost: int, debit_entry_id: int) -> int | None:
+        """Возвращает 💎 за несостоявшуюся генерацию, ссылаясь на запись о списании."""
+        return await self.change_balance(user_id, cost, LEDGER_REFUND, ref_entry_id=debit_entry_id,
+                                         completed_delta=-1)
 
-            user.generations -= cost
-            user.completed += 1
-            await session.commit()
+    async def check_unlim_status(self, user_id: int) -> bool:
+        # Обычно хватает снимка из кэша, в БД идем только чтобы погасить истекший безлимит
+        snapshot = await self.get_user(user_id)
+        if not (snapshot and snapshot.is_unlim and snapshot.unlim_time):
+            return False
+        if datetime.now() <= snapshot.unlim_time + timedelta(weeks=1):
             return True
 
-    async def check_unlim_status(self, user_id: int) -> bool:
         async with self.session_factory() as session:
             user = await session.get(User, user_id)
 
             if not (user and user.is_unlim and user.unlim_time):
+                self.cache.invalidate(user_id)
                 return False
 
 
             if datetime.now() <= user.unlim_time + timedelta(weeks=1):
+                self.cache.invalidate(user_id)
                 return True
             else:
 
@@ -156,8 +255,13 @@ class UserRepository:
                 user.is_unlim = False
                 user.unlim_time = None
 
-                user.generations = max(0, user.generations - 500)
+                new_balance = max(0, user.generations - 500)
+                if new_balance != user.generations:
+                    session.add(BalanceLedger(user_id=user_id, delta=new_balance - user.generations,
+                                              reason=LEDGER_UNLIM_EXPIRED))
+                user.generations = new_balance
                 await session.commit()
+                self.cache.invalidate(user_id)
                 return False
 
     async def get_total_user_count(self) -> int:
@@ -168,13 +272,31 @@ class UserRepository:
             return result.scalar_one()
 
     async def is_user_unlim(self, user_id: int) -> bool:
-
-        async with self.session_factory() as session:
-
-            query = select(User.is_unlim).where(User.id == user_id)
-            result = await session.execute(query)
-            is_unlim_flag = result.scalar_one_or_none()
-            return bool(is_unlim_flag)
+        user = await self.get_user(user_id)
+        return bool(user and user.is_unlim)
+
+
+def _counters_upsert(model, counters: Dict[str, Dict[str, int]]):
+    """
+    Один INSERT ... ON CONFLICT DO UPDATE для нескольких строк счетчиков (AdUrl, Statistic):
+    несуществующие строки создаются, у существующих к счетчикам прибавляются дельты.
+    Неизвестные колонки игнорируются; строки без дельт пропускаются. Возвращает None, если писать нечего.
+    """
+    columns = model.__table__.c
+    counters = {
+        name: {key: value for key, value in deltas.items() if key in columns and key != 'name' and value}
+        for name, deltas in counters.items()
+    }
+    counters = {name: deltas for name, deltas in counters.items() if deltas}
+    if not counters:
+        return None
+    keys = sorted({key for deltas in counters.values() for key in deltas})
+    rows = [{'name': name, **{key: deltas.get(key, 0) for key in keys}} for name, deltas in counters.items()]
+    stmt = insert(model).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[columns.name],
+        set_={key: columns[key] + stmt.excluded[key] for key in keys},
+    )
 
 
 class AdUrlRepository:
@@ -216,21 +338,19 @@ class AdUrlRepository:
 
     async def increment_counters(self, name: str, **counters_to_add):
         """
-        Увеличивает любые счетчики для рекламной ссылки.
+        Увеличивает любые счетчики для рекламной ссылки, создавая ее при необходимости.
         Пример: await db.ad_url.increment_counters('tg_ad', all_users=1, income=500)
         """
-        async with self.session_factory() as session:
-            await self.get_or_create(name)  # Гарантируем, что запись существует
-
-            values_to_increment = {}
-            for key, value in counters_to_add.items():
-                if hasattr(AdUrl, key):
-                    values_to_increment[key] = getattr(AdUrl, key) + value
+        await self.add_counters({name: counters_to_add})
 
-            if values_to_increment:
-                stmt = update(AdUrl).where(AdUrl.name == name).values(**values_to_increment)
-                await session.execute(stmt)
-                await session.commit()
+    async def add_counters(self, counters: Dict[str, Dict[str, int]]):
+        """Прибавляет дельты к счетчикам нескольких ссылок одним запросом: {name: {counter: delta}}."""
+        stmt = _counters_upsert(AdUrl, counters)
+        if stmt is None:
+            return
+        async with independent_session(self.session_factory) as session:
+            await session.execute(stmt)
+            await session.commit()
 
 
 class SubscriptionRepository:
@@ -292,6 +412,18 @@ class SubscriptionRepository:
             await session.commit()
             logging.info(f"Incremented subs_count for channel ID={channel_id} by {amount}")
 
+    async def bulk_increment_subs(self, channel_ids: Sequence[int], amount: int = 1):
+        """Увеличивает счетчик подписчиков сразу у нескольких каналов одним запросом."""
+        if not channel_ids:
+            return
+        async with self.session_factory() as session:
+            stmt = update(SubscriptionCheck).where(SubscriptionCheck.id.in_(set(channel_ids))).values(
+                count_subs=SubscriptionCheck.count_subs + amount
+            )
+            await session.execute(stmt)
+            await session.commit()
+            logging.info(f"Incremented subs_count for channels {sorted(set(channel_ids))} by {amount}")
+
 
 class StatisticsRepository:
     def __init__(self, session_factory: async_sessionmaker):
@@ -311,22 +443,19 @@ class StatisticsRepository:
 
     async def increment_counters(self, name: str, **counters_to_add):
         """
-        Увеличивает любые счетчики в таблице статистики.
-        Это именно тот метод, который вам нужен для поля `gpt` и других.
-        Пример: await db.statistic.increment_counters('global', gpt=1, now_day=1)
+        Увеличивает любые счетчики в таблице статистики, создавая строку при необходимости.
+        Пример: await db.statistic.increment_counters('income', all_time=500, now_month=500)
         """
-        async with self.session_factory() as session:
-            await self.get_or_create(name)  # Гарантируем, что запись существует
+        await self.add_counters({name: counters_to_add})
 
-            values_to_increment = {}
-            for key, value in counters_to_add.items():
-                if hasattr(Statistic, key):
-                    values_to_increment[key] = getattr(Statistic, key) + value
-
-            if values_to_increment:
-                stmt = update(Statistic).where(Statistic.name == name).values(**values_to_increment)
-                await session.execute(stmt)
-                await session.commit()
+    async def add_counters(self, counters: Dict[str, Dict[str, int]]):
+        """Прибавляет дельты к нескольким строкам статистики одним запросом: {name: {counter: delta}}."""
+        stmt = _counters_upsert(Statistic, counters)
+        if stmt is None:
+            return
+        async with independent_session(self.session_factory) as session:
+            await session.execute(stmt)
+            await session.commit()
 
     async def get_multiple_stats(self, names: List[str]) -> Dict[str, dict]:
         """Возвращает данные для нескольких строк статистики."""
@@ -389,3 +518,359 @@ class StartMessageRepository:
             await session.execute(stmt)
             await session.commit()
             logging.info(f"Start message delay updated to {new_delay} seconds.")
+
+
+def _effective_priority(job=GenerationJob):
+    """Приоритет задачи с учетом старения: чем дольше задача ждет, тем выше она в очереди."""
+    age = func.extract('epoch', func.now() - job.created_at)
+    return job.priority + age / JOB_PRIORITY_AGING_SECONDS
+
+
+class GenerationJobRepository:
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+
+    async def create_job(self, user_id: int, chat_id: int, model_key: str, prompt: str, params: str,
+                         cost: int, image_urls: str | None = None,
+                         status_message_id: int | None = None, cache_key: str | None = None,
+                         priority: int = 0, debit_entry_id: int | None = None) -> GenerationJob:
+        """Ставит новую задачу генерации в очередь."""
+        async with self.session_factory() as session:
+            job = GenerationJob(
+                user_id=user_id,
+                chat_id=chat_id,
+                model_key=model_key,
+                prompt=prompt,
+                params=params,
+                image_urls=image_urls,
+                cost=cost,
+                status_message_id=status_message_id,
+                cache_key=cache_key,
+                priority=priority,
+                debit_entry_id=debit_entry_id,
+            )
+            session.add(job)
+            await session.commit()
+            await session.refresh(job)
+            return job
+
+    async def get_job(self, job_id: int) -> GenerationJob | None:
+        async with self.session_factory() as session:
+            return await session.get(GenerationJob, job_id)
+
+    async def claim_next(self, model_keys: Sequence[str] | None = None) -> GenerationJob | None:
+        """
+        Атомарно забирает ожидающую задачу с наибольшим приоритетом (с учетом старения)
+        и переводит ее в статус running. При равном приоритете первой идет более старая.
+        SKIP LOCKED позволяет нескольким воркерам забирать задачи параллельно, не мешая друг другу.
+        Если передан model_keys, берутся только задачи этих моделей (у остальных нет свободных слотов).
+        """
+        filters = [GenerationJob.status == JOB_STATUS_PENDING]
+        if model_keys is not None:
+            filters.append(GenerationJob.model_key.in_(model_keys))
+        next_id = (
+            select(GenerationJob.id)
+            .where(*filters)
+            .order_by(_effective_priority().desc(), GenerationJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(GenerationJob)
+            .where(GenerationJob.id == next_id)
+            .values(status=JOB_STATUS_RUNNING, attempts=GenerationJob.attempts + 1, updated_at=func.now())
+            .returning(GenerationJob)
+            .execution_options(synchronize_session=False)
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            job = result.scalar_one_or_none()
+            await session.commit()
+            return job
+
+    async def count_pending(self, model_key: str) -> int:
+        """Сколько задач модели ждут своей очереди."""
+        stmt = select(func.count(GenerationJob.id)).where(
+            GenerationJob.status == JOB_STATUS_PENDING,
+            GenerationJob.model_key == model_key
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            return result.scalar_one()
+
+    async def queue_position(self, job: GenerationJob) -> int:
+        """
+        Место задачи в очереди своей модели, начиная с 1, в том же порядке, в котором их забирает claim_next:
+        впереди задачи с большим приоритетом с учетом старения, при равном — с меньшим id.
+        Оценка на текущий момент, позже ее может обогнать задача более высокого класса.
+        Возвращает 0, если задача уже не ждет в очереди.
+        """
+        this = aliased(GenerationJob)
+        this_priority = (
+            select(_effective_priority(this))
+            .where(this.id == job.id, this.status == JOB_STATUS_PENDING)
+            .scalar_subquery()
+        )
+        priority = _effective_priority()
+        ahead = select(func.count(GenerationJob.id)).where(
+            GenerationJob.status == JOB_STATUS_PENDING,
+            GenerationJob.model_key == job.model_key,
+            GenerationJob.id != job.id,
+            or_(priority > this_priority, and_(priority == this_priority, GenerationJob.id < job.id))
+        ).scalar_subquery()
+        stmt = select(this_priority.is_not(None), ahead)
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            pending, ahead_count = result.one()
+            return ahead_count + 1 if pending else 0
+
+    async def set_task_id(self, job_id: int, provider: str, task_id: str, provider_key: str | None = None) -> None:
+        """
+        Запоминает провайдера, ID задачи у него и ключ, которым она создана,
+        чтобы после рестарта не запускать генерацию повторно и опрашивать ее тем же ключом.
+        """
+        stmt = update(GenerationJob).where(GenerationJob.id == job_id).values(
+            provider=provider, task_id=task_id, provider_key=provider_key, updated_at=func.now()
+        )
+        async with self.session_factory() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def finish_job(self, job_id: int, status: str, result: str | None = None,
+                         error: str | None = None) -> bool:
+        """
+        Переводит выполняющуюся задачу в конечный статус.
+        Возвращает False, если задача уже была завершена кем-то другим.
+        """
+        stmt = update(GenerationJob).where(
+            GenerationJob.id == job_id,
+            GenerationJob.status.in_([JOB_STATUS_RUNNING, JOB_STATUS_DELIVERING])
+        ).values(status=status, result=result, error=error, updated_at=func.now())
+        async with self.session_factory() as session:
+            res = await session.execute(stmt)
+            await session.commit()
+            return res.rowcount > 0
+
+    async def mark_delivering(self, job_id: int) -> bool:
+        """
+        Переводит задачу из running в delivering перед отправкой результата.
+        Возвращает False, если пользователь успел ее отменить: отмена и доставка взаимно исключают друг друга.
+        """
+        stmt = update(GenerationJob).where(
+            GenerationJob.id == job_id,
+            GenerationJob.status == JOB_STATUS_RUNNING
+        ).values(status=JOB_STATUS_DELIVERING, updated_at=func.now())
+        async with self.session_factory() as session:
+            res = await session.execute(stmt)
+            await session.commit()
+            return res.rowcount > 0
+
+    async def cancel_job(self, job_id: int, user_id: int) -> GenerationJob | None:
+        """
+        Отменяет незавершенную задачу пользователя.
+        Возвращает задачу, если отмена состоялась, и None, если она уже завершена или чужая.
+        """
+        stmt = (
+            update(GenerationJob)
+            .where(
+                GenerationJob.id == job_id,
+                GenerationJob.user_id == user_id,
+                GenerationJob.status.in_([JOB_STATUS_PENDING, JOB_STATUS_RUNNING])
+            )
+            .values(status=JOB_STATUS_CANCELED, updated_at=func.now())
+            .returning(GenerationJob)
+            .execution_options(synchronize_session=False)
+        )
+        # Отмена фиксируется до обращений к провайдеру и Telegram
+        async with immediate_session(self.session_factory) as session:
+            result = await session.execute(stmt)
+            job = result.scalar_one_or_none()
+            await session.commit()
+            return job
+
+    async def requeue_running(self) -> int:
+        """
+        Возвращает в очередь задачи, которые выполнялись в момент остановки бота.
+        Вызывается один раз при старте, до запуска воркеров.
+        """
+        stmt = update(GenerationJob).where(
+            GenerationJob.status.in_([JOB_STATUS_RUNNING, JOB_STATUS_DELIVERING])
+        ).values(
+            status=JOB_STATUS_PENDING, updated_at=func.now()
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount
+
+
+class ImageUploadRepository:
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+
+    async def get(self, key: str, max_age: timedelta) -> ImageUpload | None:
+        """Возвращает загрузку, если она моложе max_age (иначе ссылка на ImgBB могла уже истечь)."""
+        stmt = select(ImageUpload).where(
+            ImageUpload.key == key,
+            ImageUpload.created_at > datetime.now() - max_age
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            return result.scalar_one_or_none()
+
+    async def save(self, key: str, url: str, content_hash: str) -> None:
+        # Одно и то же фото могут загружать параллельно: ON CONFLICT вместо SELECT + INSERT
+        stmt = insert(ImageUpload).values(key=key, url=url, content_hash=content_hash, created_at=datetime.now())
+        stmt = stmt.on_conflict_do_update(index_elements=[ImageUpload.key], set_={
+            'url': stmt.excluded.url,
+            'content_hash': stmt.excluded.content_hash,
+            'created_at': stmt.excluded.created_at,
+        })
+        async with self.session_factory() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+
+class GptDialogRepository:
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+
+    async def get(self, user_id: int) -> GptDialog | None:
+        async with self.session_factory() as session:
+            return await session.get(GptDialog, user_id)
+
+    async def save(self, user_id: int, summary: str | None, messages: str) -> None:
+        stmt = insert(GptDialog).values(user_id=user_id, summary=summary, messages=messages, updated_at=datetime.now())
+        stmt = stmt.on_conflict_do_update(index_elements=[GptDialog.user_id], set_={
+            'summary': stmt.excluded.summary,
+            'messages': stmt.excluded.messages,
+            'updated_at': stmt.excluded.updated_at,
+        })
+        async with self.session_factory() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+
+class UsageRepository:
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+
+    async def add_many(self, events: list[dict[str, Any]]) -> None:
+        """Записывает пачку событий одним INSERT."""
+        if not events:
+            return
+        async with independent_session(self.session_factory) as session:
+            await session.execute(UsageEvent.__table__.insert(), events)
+            await session.commit()
+
+    async def daily_totals(self, days: int = 7) -> list[dict[str, Any]]:
+        """Запросы и токены по дням за последние days дней."""
+        day = func.date(UsageEvent.created_at)
+        stmt = (
+            select(
+                day.label('day'),
+                func.count(UsageEvent.id).label('requests'),
+                func.coalesce(func.sum(UsageEvent.prompt_tokens), 0).label('prompt_tokens'),
+                func.coalesce(func.sum(UsageEvent.completion_tokens), 0).label('completion_tokens'),
+            )
+            .where(UsageEvent.created_at >= datetime.now() - timedelta(days=days))
+            .group_by(day)
+            .order_by(day.desc())
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            return [dict(row._mapping) for row in result]
+
+    async def top_users(self, limit: int = 10, days: int = 30) -> list[dict[str, Any]]:
+        """Пользователи, потратившие больше всего токенов за последние days дней."""
+        total = func.sum(UsageEvent.prompt_tokens + UsageEvent.completion_tokens)
+        stmt = (
+            select(
+                UsageEvent.user_id,
+                func.count(UsageEvent.id).label('requests'),
+                total.label('tokens'),
+            )
+            .where(UsageEvent.created_at >= datetime.now() - timedelta(days=days), UsageEvent.user_id.is_not(None))
+            .group_by(UsageEvent.user_id)
+            .order_by(total.desc())
+            .limit(limit)
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            return [dict(row._mapping) for row in result]
+
+
+class PaymentRepository:
+    def __init__(self, session_factory: async_sessionmaker, user_cache: UserCache):
+        self.session_factory = session_factory
+        self.user_cache = user_cache
+
+    async def apply_payment(self, provider: str, provider_payment_id: str, user_id: int, generations: int,
+                            price: int = 0, is_unlim: bool = False) -> bool:
+        """
+        Зачисляет платеж одной транзакцией: запись в payments, 💎 пользователю, 10% пригласившему,
+        доход в статистику и в рекламную ссылку пользователя.
+        Повторный вызов с тем же provider_payment_id ничего не делает и возвращает False.
+        Внутри апдейта платеж фиксируется сразу, до ответа пользователю.
+        """
+        async with immediate_session(self.session_factory) as session:
+            async with session.begin():
+                inserted = await session.execute(
+                    insert(Payment)
+                    .values(provider=provider, provider_payment_id=provider_payment_id, user_id=user_id,
+                            generations=generations, price=price, is_unlim=is_unlim)
+                    .on_conflict_do_nothing(index_elements=[Payment.provider_payment_id])
+                    .returning(Payment.id)
+                )
+                if inserted.scalar_one_or_none() is None:
+                    logging.info(f"Платеж {provider_payment_id} уже зачислен, повтор пропущен.")
+                    return False
+
+                changes = {'generations': User.generations + generations}
+                if is_unlim:
+                    changes.update(is_unlim=True, unlim_time=datetime.now())
+                user = (await session.execute(
+                    update(User).where(User.id == user_id).values(changes).returning(User.ref_id, User.ad_url)
+                )).one_or_none()
+                if user is None:
+                    # Откатываем всю транзакцию, включая запись о платеже, чтобы его можно было зачесть позже
+                    raise ValueError(f"Пользователь {user_id} для платежа {provider_payment_id} не найден.")
+
+                purchase = BalanceLedger(user_id=user_id, delta=generations, reason=LEDGER_PURCHASE,
+                                         payment_id=provider_payment_id)
+                session.add(purchase)
+                await session.flush()
+
+                if user.ref_id and not is_unlim:
+                    bonus = round(generations * 0.1)
+                    await session.execute(
+                        update(User).where(User.id == user.ref_id).values(generations=User.generations + bonus)
+                    )
+                    session.add(BalanceLedger(user_id=user.ref_id, delta=bonus, reason=LEDGER_REFERRAL_BONUS,
+                                              ref_entry_id=purchase.id))
+
+                if price:
+                    await session.execute(
+                        insert(Statistic)
+                        .values(name='income', all_time=price, now_month=price)
+                        .on_conflict_do_update(index_elements=[Statistic.name], set_={
+                            'all_time': Statistic.all_time + price,
+                            'now_month': Statistic.now_month + price,
+                        })
+                    )
+                    if user.ad_url:
+                        await session.execute(
+                            insert(AdUrl)
+                            .values(name=user.ad_url, income=price)
+                            .on_conflict_do_update(index_elements=[AdUrl.name],
+                                                   set_={'income': AdUrl.income + price})
+                        )
+        self.user_cache.invalidate(user_id, *([user.ref_id] if user.ref_id else []))
+        return True
+
+    async def last_payment_at(self, user_id: int) -> datetime | None:
+        stmt = select(func.max(Payment.created_at)).where(Payment.user_id == user_id)
+        async with self.session_factory() as session:
+            result = await session.execute(stmt)
+            return result.scalar_one_or_none()
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+from sqlalchemy import Select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+_current: ContextVar['UnitOfWork | None'] = ContextVar('unit_of_work', default=None)
+
+
+class UnitOfWork:
+    """
+    Одна сессия БД на весь апдейт Telegram. Открывается лениво — при первом обращении репозитория.
+    Записи репозиториев внутри нее не коммитятся по отдельности, а уходят одной транзакцией в конце апдейта
+    или раньше: по commit(), перед каждым внешним запросом (Bot API, HTTP-провайдеры) и сразу после записей,
+    которые двигают деньги (immediate_session). Исключение в хендлере откатывает незафиксированные записи.
+    Сессией пользуется только задача, создавшая UnitOfWork: фоновые задачи, запущенные из хендлера,
+    наследуют контекст, но работают со своими сессиями, как без UnitOfWork.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+        self._session: AsyncSession | None = None
+        self._dirty = False  # В текущей транзакции есть записи
+        self._after_transaction: list[Callable[[], None]] = []
+        self._owner = asyncio.current_task()
+        self._closed = False
+
+    @property
+    def active(self) -> bool:
+        return not self._closed and self._owner is asyncio.current_task()
+
+    @property
+    def dirty(self) -> bool:
+        """В текущей транзакции есть незафиксированные записи."""
+        return self._dirty
+
+    async def session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self.session_factory()
+        return self._session
+
+    def after_transaction(self, callback: Callable[[], None]) -> None:
+        """Выполнит callback после фиксации или отката транзакции (например, сброс кэша)."""
+        self._after_transaction.append(callback)
+
+    async def commit(self) -> None:
+        """Фиксирует накопленные записи. Сессия остается открытой, соединение возвращается в пул."""
+        try:
+            if self._session is not None:
+                await self._session.commit()
+        finally:
+            self._finish_transaction()
+
+    async def rollback(self) -> None:
+        try:
+            if self._session is not None:
+                await self._session.rollback()
+        finally:
+            self._finish_transaction()
+
+    def _finish_transaction(self) -> None:
+        self._dirty = False
+        callbacks, self._after_transaction = self._after_transaction, []
+        for callback in callbacks:
+            callback()
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> 'UnitOfWork':
+        self._token = _current.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                await self.commit()
+            else:
+                await self.rollback()
+        finally:
+            _current.reset(self._token)
+            await self.close()
+
+    @asynccontextmanager
+    async def borrow(self, commit: bool = False):
+        """Сессия для одного вызова репозитория. С commit=True транзакция фиксируется сразу после вызова."""
+        session = await self.session()
+        try:
+            yield _UnitOfWorkSession(self, session)
+        except SQLAlchemyError:
+            # После ошибки БД транзакция Postgres уже прервана, продолжить ее нельзя
+            if self._dirty:
+                logging.warning("Ошибка БД внутри апдейта: его несохраненные записи откатываются.")
+            await self.rollback()
+            raise
+        if commit:
+            await self.commit()
+        elif not self._dirty and session.in_transaction():
+            # Только чтения: не держим соединение и транзакцию открытыми, пока хендлер ждет внешние API
+            await session.commit()
+
+
+class _UnitOfWorkSession:
+    """
+    Обертка над общей сессией, которую получают репозитории.
+    commit() только отправляет изменения в БД (flush), фиксирует их UnitOfWork;
+    begin() открывает SAVEPOINT внутри общей транзакции;
+    чтения перезаписывают объекты в identity map, чтобы видеть изменения, сделанные Core-запросами.
+    """
+
+    def __init__(self, uow: UnitOfWork, session: AsyncSession):
+        self._uow = uow
+        self._session = session
+
+    async def commit(self) -> None:
+        await self._session.flush()
+        self._uow._dirty = True
+
+    def begin(self):
+        self._uow._dirty = True
+        return self._session.begin_nested()
+
+    async def get(self, *args, **kwargs):
+        kwargs.setdefault('populate_existing', True)
+        return await self._session.get(*args, **kwargs)
+
+    async def execute(self, statement, *args, **kwargs):
+        if isinstance(statement, Select):
+            statement = statement.execution_options(populate_existing=True)
+        else:
+            self._uow._dirty = True
+        return await self._session.execute(statement, *args, **kwargs)
+
+    async def scalars(self, statement, *args, **kwargs):
+        if isinstance(statement, Select):
+            statement = statement.execution_options(populate_existing=True)
+        return await self._session.scalars(statement, *args, **kwargs)
+
+    def add(self, instance) -> None:
+        self._uow._dirty = True
+        self._session.add(instance)
+
+    async def merge(self, instance, **kwargs):
+        self._uow._dirty = True
+        return await self._session.merge(instance, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._session, name)
+
+
+class UnitOfWorkSessionFactory:
+    """
+    Замена session_factory для репозиториев: внутри активного UnitOfWork отдает его общую сессию,
+    иначе — новую сессию на вызов, как раньше.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+
+    def __call__(self):
+        uow = current_unit_of_work()
+        if uow is None:
+            return self.session_factory()
+        return uow.borrow()
+
+
+def immediate_session(session_factory):
+    """
+    Сессия для записей, которые нельзя терять вместе с остальным апдейтом (платежи, списания, отмена задачи):
+    внутри UnitOfWork транзакция апдейта фиксируется сразу после вызова, вне его — обычная сессия.
+    """
+    if isinstance(session_factory, UnitOfWorkSessionFactory):
+        uow = current_unit_of_work()
+        if uow is not None:
+            return uow.borrow(commit=True)
+        return session_factory.session_factory()
+    return session_factory()
+
+
+def independent_session(session_factory):
+    """
+    Отдельная сессия мимо UnitOfWork: для фоновых записей (счетчики, учет токенов),
+    которые не должны ни попадать в транзакцию апдейта, вызвавшего сброс, ни откатываться вместе с ней.
+    """
+    if isinstance(session_factory, UnitOfWorkSessionFactory):
+        return session_factory.session_factory()
+    return session_factory()
+
+
+def current_unit_of_work() -> UnitOfWork | None:
+    uow = _current.get()
+    return uow if uow is not None and uow.active else None
+
+
+async def commit_current_unit_of_work() -> None:
+    """Фиксирует записи текущего апдейта, если они должны стать видны другим задачам прямо сейчас."""
+    uow = current_unit_of_work()
+    if uow is not None:
+        await uow.commit()
+
+
+async def commit_if_dirty() -> None:
+    """Фиксирует записи апдейта перед ожиданием внешнего API, чтобы не держать транзакцию и блокировки строк."""
+    uow = current_unit_of_work()
+    if uow is not None and uow.dirty:
+        await uow.commit()
+
+
+def after_transaction(callback: Callable[[], None]) -> None:
+    """Выполняет callback сразу, а внутри UnitOfWork — еще раз после завершения его транзакции."""
+    callback()
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.after_transaction(callback)
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """Открывает UnitOfWork на каждый апдейт. Регистрируется на dp.update как outer middleware."""
+
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        async with UnitOfWork(self.session_factory) as uow:
+            data['uow'] = uow
+            result = await handler(event, data)
+        return result
+
+
+class UnitOfWorkRequestMiddleware(BaseRequestMiddleware):
+    """
+    Фиксирует записи текущего апдейта перед каждым запросом к Bot API.
+    Регистрируется на сессии бота: bot.session.middleware(UnitOfWorkRequestMiddleware()).
+    """
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ):
+        await commit_if_dirty()
+        return await make_request(bot, method)
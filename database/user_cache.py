@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Optional
+
+from data.constants import USER_CACHE_SIZE, USER_CACHE_TTL
+from .models import User
+from .unit_of_work import after_transaction
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """Неизменяемая копия строки users. Поля совпадают с колонками модели User."""
+    id: int
+    username: Optional[str]
+    generations: int
+    completed: int
+    ref_count: int
+    ref_id: Optional[int]
+    passed: bool
+    active: bool
+    ad_url: Optional[str]
+    last_generation: Optional[datetime]
+    is_unlim: bool
+    unlim_time: Optional[datetime]
+
+    @classmethod
+    def from_user(cls, user: User) -> 'UserSnapshot':
+        return cls(**{field.name: getattr(user, field.name) for field in fields(cls)})
+
+
+USER_SNAPSHOT_FIELDS = frozenset(field.name for field in fields(UserSnapshot))
+
+
+class UserCache:
+    """
+    Кэш пользователей для UserRepository: LRU с TTL из неизменяемых снимков.
+    Каждый метод, меняющий users, сбрасывает запись пользователя. Чтение, начатое до записи,
+    не может положить в кэш устаревший снимок: put проверяет счетчик записей (version).
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[int, tuple[UserSnapshot, float]] = OrderedDict()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, user_id: int) -> UserSnapshot | None:
+        item = self._items.get(user_id)
+        if item is None or time.monotonic() - item[1] > self.ttl:
+            self._items.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return item[0]
+
+    def put(self, snapshot: UserSnapshot, version: int | None = None) -> None:
+        """Кладет снимок, если с момента чтения (version) в users ничего не записывалось."""
+        if version is not None and version != self._version:
+            return
+        self._items[snapshot.id] = (snapshot, time.monotonic())
+        self._items.move_to_end(snapshot.id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, *user_ids: int) -> None:
+        # Внутри UnitOfWork запись станет видна другим только после коммита — тогда сбрасываем еще раз
+        after_transaction(lambda: self._drop(user_ids))
+
+    def _drop(self, user_ids: tuple[int, ...]) -> None:
+        self._version += 1
+        for user_id in user_ids:
+            self._items.pop(user_id, None)
+
+    def stats(self) -> dict[str, int]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits * 100 / total) if total else 0,
+        }
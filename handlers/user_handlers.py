@@ -1,23 +1,25 @@
 # handlers/user_handlers.py
 import datetime
-import html
 import os
 import asyncio
 import logging
 import json
+import time
+from collections import OrderedDict
 from typing import Callable, Any, Awaitable
 
 from aiogram import Router, F, types, Bot, BaseMiddleware
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, Message, InputMediaPhoto, \
-    LabeledPrice, SuccessfulPayment, PreCheckoutQuery
+from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, Message, \
+    LabeledPrice, SuccessfulPayment, PreCheckoutQuery, CallbackQuery, TelegramObject
 from yookassa import Payment
 
 # Импорты из вашего проекта
 import config
 from database.database import Database
+from database.unit_of_work import commit_if_dirty
 from data.constants import *
 from keyboards.inline import (
     get_main_menu_keyboard, get_account_keyboard, aspect_menu, balance_rubles_menu, balance_choose_menu,
@@ -26,12 +28,18 @@ from keyboards.inline import (
     subscribe_button_keyboard, get_exemple_keyboard, get_student_menu,
     USER_MODELS, USER_DURATIONS, USER_PIXVERSE_MODE, USER_ASPECT_RATIO
 )
-from services.nexus_api import generate_on_nexus
-from services.replicate_api import generate_replicate_async
+from services.counters import CounterAggregator
+from services.generation_queue import GenerationQueue
+from services.http_client import HTTPClientPool
+from services.result_cache import generation_cache_key
+from services.upload_cache import UploadCache
+from services.dialog_store import DialogStore
+from services.usage import UsageRecorder
 from services.payment_service import check_payment
 from utils.helpers import calculate_generation_cost, get_crystal_price_str, download_video, check_user_op, \
     download_and_upload_images, check_user_op_single
-from utils.chat_gpt import get_text_answer, get_assistant_and_thread, generate_image
+from utils.chat_gpt import get_text_answer, stream_text_answer
+from utils.streaming import StreamingMessage
 from APIKeyManager.apikeymanager import APIKeyManager
 
 user_router = Router()
@@ -64,7 +72,75 @@ class AlbumMiddleware(BaseMiddleware):
         return
 
 
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту запросов пользователя: отдельные корзины токенов для сообщений,
+    нажатий кнопок и отправки промптов на генерацию (THROTTLE_RATES).
+    Корзины хранятся в памяти, давно не использованные вытесняются при превышении THROTTLE_MAX_BUCKETS.
+    """
+
+    def __init__(self, rates: dict[str, tuple[float, int]] = THROTTLE_RATES, max_buckets: int = THROTTLE_MAX_BUCKETS):
+        self.rates = rates
+        self.max_buckets = max_buckets
+        # (тип события, user_id) -> [токены, время последнего пополнения]
+        self.buckets: OrderedDict[tuple[str, int], list[float]] = OrderedDict()
+        self.warned: set[int] = set()
+
+    def _take(self, kind: str, user_id: int) -> bool:
+        rate, capacity = self.rates[kind]
+        now = time.monotonic()
+        key = (kind, user_id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(capacity), now]
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery):
+            if not self._take('callback', user.id):
+                await event.answer('⏳ Слишком часто, подождите немного', show_alert=False)
+                return
+            return await handler(event, data)
+
+        if isinstance(event, Message):
+            if event.successful_payment:  # Оплату обрабатываем всегда
+                return await handler(event, data)
+            kind = 'submit' if data.get('raw_state') == GenStates.waiting_for_prompt.state else 'message'
+            if not self._take(kind, user.id):
+                # Предупреждаем один раз за серию, остальные лишние сообщения просто игнорируем
+                if kind == 'submit' and user.id not in self.warned:
+                    if len(self.warned) >= self.max_buckets:
+                        self.warned.clear()
+                    self.warned.add(user.id)
+                    await event.answer('⏳ Вы отправляете запросы слишком часто, подождите немного.')
+                return
+            self.warned.discard(user.id)
+        return await handler(event, data)
+
+
 user_router.message.middleware(AlbumMiddleware())
+# Регистрируется после AlbumMiddleware, чтобы альбом считался одним сообщением
+throttling_middleware = ThrottlingMiddleware()
+user_router.message.middleware(throttling_middleware)
+user_router.callback_query.middleware(throttling_middleware)
 
 
 class GenStates(StatesGroup):
@@ -153,6 +229,8 @@ async def message_start(message: types.Message, db: Database, bot: Bot):
             except (json.JSONDecodeError, TypeError) as e:
                 logging.error(f"Ошибка при декодировании клавиатуры из JSON: {e}")
 
+        # Записи /start фиксируем до паузы, чтобы не держать транзакцию открытой delay_seconds
+        await commit_if_dirty()
         await asyncio.sleep(copy_message.delay_seconds)
 
         await bot.copy_message(
@@ -166,7 +244,8 @@ async def message_start(message: types.Message, db: Database, bot: Bot):
 # --- Хендлеры ---
 
 @user_router.message(Command("start"))
-async def cmd_start(message: types.Message, db: Database, state: FSMContext, bot: Bot):
+async def cmd_start(message: types.Message, db: Database, state: FSMContext, bot: Bot, http: HTTPClientPool,
+                    counters: CounterAggregator):
     await state.clear()
 
     parts = message.text.split(' ', 1)
@@ -201,13 +280,13 @@ async def cmd_start(message: types.Message, db: Database, state: FSMContext, bot
     if url_name:
         if is_new:
             logging.info(f"User {user.id} is new, ad_url: {url_name}. Updating unique stats.")
-            await db.ad_url.increment_counters(name=url_name, all_users=1, unique_users=1)
-            await db.statistic.increment_counters(name='users', now_month=1)
+            counters.ad_url(url_name, all_users=1, unique_users=1)
+            counters.statistic('users', now_month=1)
         else:
             logging.info(f"User {user.id} is existing, ad_url: {url_name}. Updating non-unique stats.")
-            await db.ad_url.increment_counters(name=url_name, all_users=1, not_unique_users=1)
+            counters.ad_url(url_name, all_users=1, not_unique_users=1)
 
-    op_answer = await check_user_op(db, bot, message.from_user.id)
+    op_answer = await check_user_op(http, db, bot, message.from_user.id)
     if op_answer is not None:
         await message.answer(
             'Подпишитесь на каналы чтобы пользоваться ботом!',
@@ -324,9 +403,8 @@ async def cb_model_selected(callback: types.CallbackQuery, state: FSMContext):
 
 
 @user_router.callback_query(F.data == 'start_chat')
-async def start_gpt_chat(callback: types.CallbackQuery, state: FSMContext):
-    assistant_id, thread_id = await get_assistant_and_thread()
-    await state.update_data(assistant_id=assistant_id, thread_id=thread_id)
+async def start_gpt_chat(callback: types.CallbackQuery, state: FSMContext, dialog_store: DialogStore):
+    await dialog_store.reset(callback.from_user.id)
     await state.set_state(DialogStates.waiting_for_prompt)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Закончить диалог ✖️', callback_data='back_main')]])
     text = ('🤖 SUPER GPT активен!\n\nЯ готов ответить на любые вопросы и помочь с идеями'
@@ -341,7 +419,8 @@ async def start_gpt_chat(callback: types.CallbackQuery, state: FSMContext):
 
 
 @user_router.message(DialogStates.waiting_for_prompt)
-async def answer_gpt(message: types.Message, state: FSMContext):
+async def answer_gpt(message: types.Message, state: FSMContext, dialog_store: DialogStore,
+                     usage_recorder: UsageRecorder):
     try:
         await message.bot.edit_message_reply_markup(
             chat_id=message.from_user.id,
@@ -349,17 +428,31 @@ async def answer_gpt(message: types.Message, state: FSMContext):
         )
     except Exception:
         ...
-    msg_to_del = await message.answer('✍️')
-    state_data = await state.get_data()
-    assistant_id, thread_id = state_data.get('assistant_id'), state_data.get('thread_id')
+    placeholder = await message.answer('✍️')
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text='Закончить диалог ✖️', callback_data='back_main')]])
     prompt = message.text if message.text else message.caption
-    answer = await get_text_answer(prompt, assistant_id, thread_id)
+    dialog = await dialog_store.get(message.from_user.id)
+    user_message = {'role': 'user', 'content': prompt or ''}
+    # Ответ выводится в сообщение-заглушку и дописывается по мере генерации
+    reply = StreamingMessage(placeholder, keyboard)
+    try:
+        if GPT_STREAM_ANSWERS:
+            async for delta in stream_text_answer([*dialog.prompt(), user_message], usage=usage_recorder,
+                                                  user_id=message.from_user.id):
+                await reply.feed(delta)
+            answer = reply.text or None
+        else:
+            answer = await get_text_answer([*dialog.prompt(), user_message], usage=usage_recorder,
+                                           user_id=message.from_user.id)
+    except Exception as e:
+        logging.error(f"Ошибка ответа GPT: {e}")
+        answer = None
     if answer is None:
-        answer = '❗️Во время операции произошла какая-то ошибка, пожалуйста попробуйте снова'
-    await msg_to_del.delete()
-    await message.answer(answer, reply_markup=keyboard)
+        await reply.finish('❗️Во время операции произошла какая-то ошибка, пожалуйста попробуйте снова')
+        return
+    await reply.finish(answer)
+    await dialog_store.add(message.from_user.id, user_message, {'role': 'assistant', 'content': answer})
 
 
 @user_router.callback_query(F.data == 'for_students')
@@ -542,21 +635,15 @@ async def process_successful_payment(payment_id, callback, db, amount, price):
     is_paid, _ = await check_payment(payment_id)
     if is_paid:
         user_id = callback.from_user.id
+        # Повторная проверка того же платежа ничего не начислит: payments.provider_payment_id уникален
         if amount == 'unlim':
-            await db.user.grant_unlim_access(user_id)
-            await db.user.increase_value(user_id, 'generations', 50)
+            applied = await db.payment.apply_payment(PAYMENT_PROVIDER_YOOKASSA, payment_id, user_id,
+                                                     UNLIM_BONUS_GENERATIONS, price=int(price), is_unlim=True)
         else:
-            user = await db.user.get_user(user_id)
-            if user.ref_id:
-                await db.user.increase_value(user.ref_id, 'generations', round(amount * 0.1))
-            await db.user.increase_value(user_id, 'generations', amount)
-
-        await db.statistic.increment_counters('income', all_time=price, now_month=price)
-        ad_url = await db.user.get_user_value(user_id, 'ad_url')
-        if ad_url:
-            await db.ad_url.increment_counters(ad_url, income=int(price))
-
-        await callback.message.answer('✅ Оплата прошла успешно. Ваш баланс пополнен!')
+            applied = await db.payment.apply_payment(PAYMENT_PROVIDER_YOOKASSA, payment_id, user_id,
+                                                     int(amount), price=int(price))
+        if applied:
+            await callback.message.answer('✅ Оплата прошла успешно. Ваш баланс пополнен!')
 
 
 @user_router.callback_query(F.data == "account")
@@ -587,7 +674,10 @@ async def handle_prompt(
         state: FSMContext,
         db: Database,
         bot: Bot,
-        album: list[types.Message]
+        album: list[types.Message],
+        generation_queue: GenerationQueue,
+        http: HTTPClientPool,
+        upload_cache: UploadCache
 ):
     user_id = message.from_user.id
     user = await db.user.get_user(user_id)
@@ -605,14 +695,28 @@ async def handle_prompt(
         await message.answer("Пожалуйста, добавьте текстовое описание (промпт).")
         return
 
+    # Проверяем до загрузки фото и до траты бесплатной генерации дня
+    if await generation_queue.is_full(model_key):
+        await state.clear()
+        await message.answer("⏳ Сейчас слишком много запросов к этой модели. Попробуйте чуть позже, 💎 не списаны.")
+        return
+
     # 2. Определяем параметры и стоимость для каждой модели
     params = {"prompt": prompt}
     cost = 0
     image_urls = []  # Инициализируем заранее
+    image_hashes = []
 
     # Загружаем изображения один раз, если они есть
     if any(msg.photo for msg in album):
-        image_urls = await download_and_upload_images(bot, album)
+        upload = await download_and_upload_images(http, bot, album, model_key,
+                                                  USER_ASPECT_RATIO.get(user_id, "16:9"), upload_cache)
+        if upload.failed:
+            numbers = ', '.join(str(number) for number in upload.failed)
+            await message.answer(f"Не удалось загрузить фото №{numbers}. Попробуйте отправить запрос еще раз, 💎 не списаны.")
+            return
+        image_urls = [image.url for image in upload.images]
+        image_hashes = [image.content_hash for image in upload.images]
     if model_key == 'Sora - Генерация изображений':
         if not user.last_generation or (user.last_generation.day != datetime.datetime.now().day):
             await db.user.update_user(user_id, last_generation=datetime.datetime.now())
@@ -653,54 +757,46 @@ async def handle_prompt(
     await state.clear()
 
     status_message = "⏳ Принял. Отправляю запрос..."
+    debit_entry_id = None
     if image_urls:
         status_message = "⏳ Принял. Загрузил фото и отправляю на обработку..."
-    elif not cost or not await db.user.process_generation(user_id, cost):
+    elif not cost or not (debit_entry_id := await db.user.process_generation(user_id, cost)):
         await message.answer("У вас закончились генерации или произошла ошибка списания. Пополните баланс!",
                              reply_markup=balance_choose_menu())
         return
-    msg = await message.answer(f"{status_message} Это будет стоить {cost} 💎")
     try:
-        # 4. Отправляем запрос в API
-        if model_key == 'Sora - Генерация изображений':
-            result_urls = await generate_image(image_urls, prompt)
-        else:
-            result_urls = await generate_on_nexus(params)
-
-        if not result_urls:
-            raise RuntimeError("API не вернул результат.")
-
-        await msg.delete()
-        safe_prompt = html.escape(params["prompt"])
-
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text='⬅️ На главное меню', callback_data='back_main')]])
-        if model_key == 'Sora - Генерация изображений':
-            media_group = [InputMediaPhoto(media=url) for url in result_urls]
-            if media_group:
-                media_group[0].caption = f"🖼️ <b>Готово!</b>\n<b>Промпт:</b> <code>{safe_prompt}</code>"
-                media_group[0].parse_mode = 'HTML'
-                message_to_copy = await bot.send_media_group(chat_id=user_id, media=media_group)
-                await bot.copy_messages(
-                    chat_id=-1002858090617,
-                    from_chat_id=message.chat.id,
-                    message_ids=[msg.message_id for msg in message_to_copy]
-                )
-        else:  # Для всех видеомоделей, включая Veo
-            video_url = result_urls[0]
-            caption = f"🎬 <b>Видео готово!</b>\n<b>Промпт:</b> <code>{safe_prompt}</code>\n<b>Модель:</b> {model_key}"
-            await message.answer_video(video_url, caption=caption, parse_mode='HTML')
-
-        await message.answer('Вы можете вернуться на главное меню', reply_markup=keyboard)
-        await db.statistic.increment_counters(model_key, all_time=1, now_month=1)
+        msg = await message.answer(f"{status_message} Это будет стоить {cost} 💎")
+        priority = await generation_queue.priority_for(user_id, cost)
+        # 4. Ставим задачу в очередь: запуск, ожидание и доставку результата выполнит воркер
+        await generation_queue.enqueue(
+            user_id=user_id,
+            chat_id=message.chat.id,
+            model_key=model_key,
+            prompt=prompt,
+            params=params,
+            cost=cost,
+            image_urls=image_urls,
+            status_message_id=msg.message_id,
+            cache_key=generation_cache_key(params, image_hashes),
+            priority=priority,
+            debit_entry_id=debit_entry_id,
+            # Место в очереди и кнопку отмены дописывает очередь: до этого воркер не трогает статусное сообщение
+            status_text=msg.text,
+        )
+    except Exception:
+        # Списание уже зафиксировано, а задачи, которая вернула бы 💎 при ошибке, нет — возвращаем здесь
+        if debit_entry_id:
+            await db.user.refund_generation(user_id, cost, debit_entry_id)
+        raise
 
-    except Exception as e:
-        logging.error(f"Ошибка генерации для модели {model_key}: {e}", exc_info=True)
-        await db.user.increase_value(user_id, 'generations', cost)
-        await db.user.increase_value(user_id, 'completed', -1)
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='⬅️ Назад', callback_data='back_main')]])
-        await msg.edit_text(f"❌ <b>Ошибка:</b>\n<code>{html.escape(str(e))}</code>\n\nВаши 💎 возвращены на баланс.", reply_markup=keyboard,
-                            parse_mode='HTML')
+
+@user_router.callback_query(F.data.startswith('cancel_job:'))
+async def cancel_generation_handler(callback: types.CallbackQuery, generation_queue: GenerationQueue):
+    job_id = int(callback.data.split(':')[1])
+    if await generation_queue.cancel(job_id, callback.from_user.id):
+        await callback.answer('Генерация отменена')
+    else:
+        await callback.answer('Генерацию уже нельзя отменить', show_alert=True)
 
 
 @user_router.pre_checkout_query()
@@ -718,33 +814,33 @@ async def successful_payment_handler(message: Message, db: Database):
     logging.info(f"Successful payment from {user_id}: {message.successful_payment.invoice_payload}")
 
     amount = message.successful_payment.invoice_payload
+    payment_id = message.successful_payment.telegram_payment_charge_id
 
+    # Доход в рублях для Stars не считаем, как и раньше: price не передаем
     if amount == 'unlim':
-        await db.user.grant_unlim_access(user_id)
-        await db.user.increase_value(user_id, 'generations', 50)
+        applied = await db.payment.apply_payment(PAYMENT_PROVIDER_STARS, payment_id, user_id,
+                                                 UNLIM_BONUS_GENERATIONS, is_unlim=True)
     else:
-        user = await db.user.get_user(user_id)
-        if user.ref_id:
-            await db.user.increase_value(user.ref_id, 'generations', round(int(amount) * 0.1))
-        await db.user.increase_value(user_id, 'generations', int(amount))
+        applied = await db.payment.apply_payment(PAYMENT_PROVIDER_STARS, payment_id, user_id, int(amount))
 
-    await message.answer('✅ Оплата прошла успешно. Ваш баланс пополнен!')
+    if applied:
+        await message.answer('✅ Оплата прошла успешно. Ваш баланс пополнен!')
 
 
 @user_router.callback_query(F.data == 'check_op')
-async def check_op_user_func(call: types.CallbackQuery, db: Database, state: FSMContext, bot: Bot):
+async def check_op_user_func(call: types.CallbackQuery, db: Database, state: FSMContext, bot: Bot,
+                             http: HTTPClientPool):
     channels = await db.subscription.get_all_channels()
-    answer = await check_user_op(db, bot, call.from_user.id)
+    answer = await check_user_op(http, db, bot, call.from_user.id)
     if answer is None:
         data = await state.get_data()
         ref_id = data.get('ref_id')
         if ref_id:
-            await db.user.increase_value(ref_id, 'generations', 10)
+            await db.user.change_balance(ref_id, 10, LEDGER_REFERRAL_BONUS)
             await db.user.increase_value(ref_id, 'ref_count', 1)
         await db.user.update_user(call.from_user.id, passed=True)
         op_ids = data.get('not_passed')
-        for op_id in op_ids:
-            await db.subscription.increment_subs_count(op_id)
+        await db.subscription.bulk_increment_subs(op_ids or [])
         await call.message.edit_text('Вы можете пользоваться ботом! ✅')
     else:
         await call.answer('Вы не подписались на каналы!', show_alert=True)
@@ -178,6 +178,12 @@ def get_prompt_keyboard(user_id: int, selected_model: str) -> InlineKeyboardMark
     )
 
 
+def cancel_generation_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='✖️ Отменить', callback_data=f'cancel_job:{job_id}')]
+    ])
+
+
 def get_exemple_keyboard(url: str):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -0,0 +1,63 @@
+# services/counters.py
+import asyncio
+import logging
+from collections import Counter, defaultdict
+
+from database.database import Database
+from data.constants import COUNTER_FLUSH_INTERVAL
+
+
+class CounterAggregator:
+    """
+    Отложенная запись счетчиков Statistic и AdUrl. Хендлеры только прибавляют дельты в памяти,
+    а фоновая задача раз в flush_interval секунд (и при остановке) пишет накопленное —
+    по одному INSERT ... ON CONFLICT DO UPDATE на таблицу.
+    Если запись не удалась, дельты возвращаются в буфер и уйдут при следующей попытке.
+    """
+
+    def __init__(self, db: Database, flush_interval: float = COUNTER_FLUSH_INTERVAL):
+        self.db = db
+        self.flush_interval = flush_interval
+        self._statistic: defaultdict[str, Counter] = defaultdict(Counter)
+        self._ad_url: defaultdict[str, Counter] = defaultdict(Counter)
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def statistic(self, name: str, **counters: int) -> None:
+        self._statistic[name].update(counters)
+
+    def ad_url(self, name: str, **counters: int) -> None:
+        self._ad_url[name].update(counters)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Пишет накопленные счетчики. Вызывается и перед показом статистики, чтобы цифры были свежими."""
+        async with self._flush_lock:
+            await self._flush_table('statistic', self._statistic, self.db.statistic.add_counters)
+            await self._flush_table('ad_url', self._ad_url, self.db.ad_url.add_counters)
+
+    async def _flush_table(self, label: str, buffer: defaultdict[str, Counter], write) -> None:
+        if not buffer:
+            return
+        pending = {name: dict(deltas) for name, deltas in buffer.items()}
+        buffer.clear()
+        try:
+            await write(pending)
+        except Exception as e:
+            logging.error(f"Не удалось записать счетчики {label} ({len(pending)} строк): {e}")
+            for name, deltas in pending.items():
+                buffer[name].update(deltas)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,93 @@
+# services/dialog_store.py
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from database.database import Database
+from data.constants import GPT_HISTORY_TOKEN_BUDGET, GPT_HISTORY_KEEP_MESSAGES, GPT_DIALOG_CACHE_SIZE
+
+Summarizer = Callable[[str | None, list[dict[str, str]]], Awaitable[str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: для русского текста около 3 символов на токен."""
+    return len(text) // 3 + 1
+
+
+@dataclass
+class Dialog:
+    summary: str | None = None
+    messages: list[dict[str, str]] = field(default_factory=list)
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.summary or '') + sum(estimate_tokens(m['content']) for m in self.messages)
+
+    def prompt(self) -> list[dict[str, str]]:
+        """Сообщения для запроса к модели: краткое содержание старой части и последние реплики."""
+        if not self.summary:
+            return list(self.messages)
+        return [{'role': 'system', 'content': f"Краткое содержание начала диалога: {self.summary}"}, *self.messages]
+
+
+class DialogStore:
+    """
+    Истории диалогов с GPT. Хранятся в таблице gpt_dialogs, активные — еще и в памяти (LRU).
+    Когда история превышает GPT_HISTORY_TOKEN_BUDGET, старые сообщения сворачиваются
+    в краткое содержание, а последние GPT_HISTORY_KEEP_MESSAGES остаются дословно.
+    """
+
+    def __init__(self, db: Database, summarizer: Summarizer, token_budget: int = GPT_HISTORY_TOKEN_BUDGET,
+                 keep_messages: int = GPT_HISTORY_KEEP_MESSAGES, max_cached: int = GPT_DIALOG_CACHE_SIZE):
+        self.db = db
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.keep_messages = keep_messages
+        self.max_cached = max_cached
+        self._dialogs: OrderedDict[int, Dialog] = OrderedDict()
+
+    async def get(self, user_id: int) -> Dialog:
+        dialog = self._dialogs.get(user_id)
+        if dialog is None:
+            row = await self.db.gpt_dialog.get(user_id)
+            dialog = Dialog(row.summary, json.loads(row.messages)) if row else Dialog()
+        self._remember(user_id, dialog)
+        return dialog
+
+    async def reset(self, user_id: int) -> None:
+        """Начинает новый диалог."""
+        dialog = Dialog()
+        self._remember(user_id, dialog)
+        await self._save(user_id, dialog)
+
+    async def add(self, user_id: int, *messages: dict[str, str]) -> None:
+        """Добавляет реплики в историю, при необходимости сворачивает ее и сохраняет."""
+        dialog = await self.get(user_id)
+        dialog.messages.extend(messages)
+        await self._trim(dialog)
+        await self._save(user_id, dialog)
+
+    async def _trim(self, dialog: Dialog) -> None:
+        if dialog.tokens() <= self.token_budget:
+            return
+        old, recent = dialog.messages[:-self.keep_messages], dialog.messages[-self.keep_messages:]
+        if old:
+            try:
+                dialog.summary = await self.summarizer(dialog.summary, old)
+            except Exception as e:
+                # Без краткого содержания старая часть просто теряется, но диалог продолжается
+                logging.error(f"Не удалось свернуть историю диалога: {e}")
+            dialog.messages = recent
+        # Даже последние сообщения могут не влезть (например, огромный вставленный текст)
+        while len(dialog.messages) > 1 and dialog.tokens() > self.token_budget:
+            dialog.messages.pop(0)
+
+    async def _save(self, user_id: int, dialog: Dialog) -> None:
+        await self.db.gpt_dialog.save(user_id, dialog.summary, json.dumps(dialog.messages, ensure_ascii=False))
+
+    def _remember(self, user_id: int, dialog: Dialog) -> None:
+        self._dialogs[user_id] = dialog
+        self._dialogs.move_to_end(user_id)
+        while len(self._dialogs) > self.max_cached:
+            self._dialogs.popitem(last=False)
@@ -0,0 +1,395 @@
+# services/generation_queue.py
+import asyncio
+import html
+import json
+import logging
+from collections import deque
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, BufferedInputFile
+
+from database.database import Database
+from database.models import GenerationJob
+from database.unit_of_work import commit_current_unit_of_work
+from keyboards.inline import cancel_generation_keyboard
+from data.constants import (
+    ARCHIVE_CHAT_ID, GENERATION_WORKERS, GENERATION_QUEUE_POLL_INTERVAL, GENERATION_JOB_MAX_ATTEMPTS,
+    JOB_STATUS_COMPLETED, JOB_STATUS_FAILED, MODELS, MODEL_CONCURRENCY_LIMITS, DEFAULT_MODEL_CONCURRENCY,
+    GENERATION_QUEUE_MAX_DEPTH, JOB_PRIORITY_FREE, JOB_PRIORITY_PAID, JOB_PRIORITY_RECENT_PAYER, JOB_PRIORITY_UNLIM,
+    JOB_PRIORITY_NAMES, RECENT_PAYMENT_WINDOW, JOB_WAIT_SAMPLES
+)
+from services.counters import CounterAggregator
+from services.http_client import HTTPClientPool
+from services.providers import ProviderRouter
+from services.result_cache import ResultCache
+from services.usage import UsageRecorder
+from utils.chat_gpt import generate_image
+
+
+class GenerationQueue:
+    """
+    Пул воркеров, которые разбирают очередь задач генерации из таблицы generation_jobs.
+    Хендлер только ставит задачу в очередь и сразу возвращается, а запуск, ожидание результата,
+    доставка и возврат 💎 при ошибке происходят здесь. Каждая смена статуса пишется в БД,
+    поэтому после рестарта незавершенные задачи подхватываются заново.
+
+    Для каждой модели действует свой лимит одновременных генераций (MODEL_CONCURRENCY_LIMITS).
+    Задачи из БД забирает один диспетчер — только для моделей со свободными слотами и только когда
+    есть свободный воркер — и передает их воркерам через asyncio.Queue. Так на одну новую задачу
+    приходится один запрос claim_next, а не по запросу от каждого простаивающего воркера.
+
+    Задачи безлимитных и недавно оплативших пользователей забираются раньше обычных платных,
+    а бесплатные ежедневные генерации — в последнюю очередь. Ожидающие задачи со временем
+    поднимаются в приоритете (JOB_PRIORITY_AGING_SECONDS), поэтому низкий класс тоже доходит до воркера.
+    """
+
+    def __init__(self, bot: Bot, db: Database, http: HTTPClientPool, router: ProviderRouter,
+                 result_cache: ResultCache, counters: CounterAggregator, usage: UsageRecorder | None = None,
+                 workers: int = GENERATION_WORKERS,
+                 poll_interval: float = GENERATION_QUEUE_POLL_INTERVAL,
+                 max_depth: int = GENERATION_QUEUE_MAX_DEPTH):
+        self.bot = bot
+        self.db = db
+        self.http = http
+        self.router = router
+        self.result_cache = result_cache
+        self.counters = counters
+        self.usage = usage
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_depth = max_depth
+        self._running: dict[str, int] = {model_key: 0 for model_key in MODELS}
+        self._wakeup = asyncio.Event()
+        self._jobs: asyncio.Queue[GenerationJob] = asyncio.Queue()
+        self._idle_workers = asyncio.Semaphore(workers)
+        self._tasks: list[asyncio.Task] = []
+        # Выполняющиеся задачи этого процесса: id задачи -> корутина генерации, которую можно отменить
+        self._active: dict[int, asyncio.Task] = {}
+        self._canceled: set[int] = set()
+        # Задачи, чье статусное сообщение еще не обновлено после постановки в очередь:
+        # воркер ждет, чтобы его собственные правки (ошибка, возврат) не были перезаписаны
+        self._announcing: dict[int, asyncio.Event] = {}
+        self._wait_times: dict[int, deque[float]] = {
+            priority: deque(maxlen=JOB_WAIT_SAMPLES) for priority in JOB_PRIORITY_NAMES
+        }
+
+    async def start(self) -> None:
+        """Возвращает в очередь прерванные задачи и запускает воркеров."""
+        requeued = await self.db.generation_job.requeue_running()
+        if requeued:
+            logging.info(f"Возвращено в очередь {requeued} незавершенных задач генерации.")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._dispatcher()))
+        logging.info(f"Очередь генераций запущена, воркеров: {self.workers}")
+
+    async def stop(self) -> None:
+        """
+        Останавливает диспетчер и воркеров. Прерванные задачи остаются в статусе running
+        и будут подхвачены при следующем старте.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    def concurrency_limit(model_key: str) -> int:
+        return MODEL_CONCURRENCY_LIMITS.get(model_key, DEFAULT_MODEL_CONCURRENCY)
+
+    async def is_full(self, model_key: str) -> bool:
+        """
+        Проверка перед списанием 💎: если в очереди модели уже слишком много задач,
+        новый запрос отклоняется сразу, не дожидаясь таймаутов у провайдера.
+        """
+        return await self.db.generation_job.count_pending(model_key) >= self.max_depth
+
+    async def queue_position(self, job: GenerationJob) -> int:
+        return await self.db.generation_job.queue_position(job)
+
+    async def priority_for(self, user_id: int, cost: int) -> int:
+        if await self.db.user.check_unlim_status(user_id):
+            return JOB_PRIORITY_UNLIM
+        # Оплату берем из БД: она не теряется при перезапуске и видна всем процессам
+        paid_at = await self.db.payment.last_payment_at(user_id)
+        if paid_at is not None and (datetime.now() - paid_at).total_seconds() <= RECENT_PAYMENT_WINDOW:
+            return JOB_PRIORITY_RECENT_PAYER
+        if not cost:
+            return JOB_PRIORITY_FREE
+        return JOB_PRIORITY_PAID
+
+    def wait_stats(self) -> list[dict]:
+        """Время ожидания в очереди по классам приоритета (по последним JOB_WAIT_SAMPLES задачам)."""
+        stats = []
+        for priority in sorted(self._wait_times, reverse=True):
+            samples = sorted(self._wait_times[priority])
+            stats.append({
+                'name': JOB_PRIORITY_NAMES.get(priority, str(priority)),
+                'count': len(samples),
+                'avg': round(sum(samples) / len(samples)) if samples else 0,
+                'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))]) if samples else 0,
+            })
+        return stats
+
+    def _free_models(self) -> list[str]:
+        return [model_key for model_key, running in self._running.items()
+                if running < self.concurrency_limit(model_key)]
+
+    async def _claim(self) -> GenerationJob | None:
+        """Забирает задачу одной из моделей со свободным слотом и занимает этот слот. Вызывает только диспетчер."""
+        free_models = self._free_models()
+        if not free_models:
+            return None
+        job = await self.db.generation_job.claim_next(free_models)
+        if job is not None:
+            self._running[job.model_key] = self._running.get(job.model_key, 0) + 1
+            if job.attempts == 1:
+                # claim_next проставляет updated_at в момент захвата, так что это время ожидания по часам БД
+                waited = (job.updated_at - job.created_at).total_seconds()
+                self._wait_times.setdefault(job.priority, deque(maxlen=JOB_WAIT_SAMPLES)).append(waited)
+        return job
+
+    def _release(self, job: GenerationJob) -> None:
+        self._running[job.model_key] = max(0, self._running.get(job.model_key, 0) - 1)
+        # Освободился слот модели — возможно, ее задача ждет в БД
+        self._wakeup.set()
+
+    async def enqueue(self, user_id: int, chat_id: int, model_key: str, prompt: str, params: dict,
+                      cost: int, image_urls: list[str] | None = None,
+                      status_message_id: int | None = None, cache_key: str | None = None,
+                      priority: int = JOB_PRIORITY_PAID, debit_entry_id: int | None = None,
+                      status_text: str | None = None) -> GenerationJob:
+        """
+        Ставит задачу в очередь и будит диспетчер.
+        Если передан status_text, дописывает в статусное сообщение место в очереди и кнопку отмены.
+        """
+        job = await self.db.generation_job.create_job(
+            user_id=user_id,
+            chat_id=chat_id,
+            model_key=model_key,
+            prompt=prompt,
+            params=json.dumps(params, ensure_ascii=False),
+            cost=cost,
+            image_urls=json.dumps(image_urls) if image_urls else None,
+            status_message_id=status_message_id,
+            cache_key=cache_key,
+            priority=priority,
+            debit_entry_id=debit_entry_id,
+        )
+        announced = None
+        if status_message_id and status_text:
+            announced = self._announcing[job.id] = asyncio.Event()
+        # Диспетчер и воркеры работают в своих сессиях: задача и списание должны быть зафиксированы до пробуждения
+        await commit_current_unit_of_work()
+        self._wakeup.set()
+        if announced is not None:
+            await self._announce(job, status_text, announced)
+        return job
+
+    async def _announce(self, job: GenerationJob, status_text: str, announced: asyncio.Event) -> None:
+        try:
+            position = await self.queue_position(job)
+            text = f"{status_text}\nВаше место в очереди: {position}" if position else status_text
+            await self.bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.status_message_id,
+                                             reply_markup=cancel_generation_keyboard(job.id))
+        except Exception as e:
+            logging.debug(f"Не удалось обновить статус задачи {job.id}: {e}")
+        finally:
+            self._announcing.pop(job.id, None)
+            announced.set()
+
+    async def _dispatcher(self) -> None:
+        """Единственный, кто ходит в claim_next: ждет свободного воркера, забирает задачу и отдает ее в _jobs."""
+        while True:
+            await self._idle_workers.acquire()
+            try:
+                while True:
+                    # Сбрасываем флаг до запроса, чтобы не потерять задачу, поставленную во время claim_next
+                    self._wakeup.clear()
+                    try:
+                        job = await self._claim()
+                    except Exception as e:
+                        logging.error(f"Диспетчер очереди генераций не смог забрать задачу: {e}", exc_info=True)
+                        job = None
+                    if job is not None:
+                        break
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._idle_workers.release()
+                raise
+            self._jobs.put_nowait(job)
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            job = await self._jobs.get()
+            try:
+                # Генерация идет в отдельной задаче, чтобы отмена пользователем не останавливала сам воркер
+                processing = asyncio.create_task(self._process(job))
+                self._active[job.id] = processing
+                try:
+                    await processing
+                except asyncio.CancelledError:
+                    if job.id not in self._canceled:
+                        raise
+                finally:
+                    self._active.pop(job.id, None)
+                    self._canceled.discard(job.id)
+                    self._release(job)
+                    self._idle_workers.release()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Воркер генераций #{number} упал: {e}", exc_info=True)
+
+    async def _process(self, job: GenerationJob) -> None:
+        announcing = self._announcing.get(job.id)
+        if announcing is not None:
+            await announcing.wait()
+        cached = self.result_cache.get(job.cache_key)
+        try:
+            if job.attempts > GENERATION_JOB_MAX_ATTEMPTS:
+                raise RuntimeError("Задача прерывалась слишком много раз.")
+            if cached:
+                logging.info(f"Задача {job.id} отдана из кэша результатов.")
+                result = list(cached.urls)
+            else:
+                result = await self._run(job)
+                if not result:
+                    raise RuntimeError("API не вернул результат.")
+                # Кэшируем ссылки до доставки: если доставка сорвется, повторный запрос не оплатит провайдера снова
+                self.result_cache.put(job.cache_key, [item for item in result if isinstance(item, str)], [])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка генерации для модели {job.model_key} (задача {job.id}): {e}", exc_info=True)
+            await self._fail(job, e)
+            return
+
+        # С этого момента результат уже у нас, и отменять генерацию поздно. Статус меняется условно,
+        # поэтому либо отмена, либо доставка: если пользователь успел отменить, результат не отправляем
+        if not await self.db.generation_job.mark_delivering(job.id):
+            logging.info(f"Задача {job.id} отменена до доставки результата.")
+            return
+        try:
+            # Из кэша отправляем по file_id: Telegram не будет заново скачивать файл по ссылке
+            file_ids = await self._deliver(job, list(cached.file_ids) if cached and cached.file_ids else result)
+        except Exception as e:
+            logging.error(f"Ошибка доставки результата задачи {job.id}: {e}", exc_info=True)
+            if cached:
+                # Свежие ссылки получают одну попытку повтора из кэша; если не доставились и они
+                # (ссылка истекла, Telegram не может ее скачать), запись убираем, чтобы не отказывать до конца TTL
+                self.result_cache.invalidate(job.cache_key)
+            await self._fail(job, e)
+            return
+
+        # Картинки Sora приходят байтами и ссылок у них нет — для них результатом считаются file_id
+        result_urls = [item for item in result if isinstance(item, str)]
+        if not (cached and cached.file_ids):
+            self.result_cache.put(job.cache_key, result_urls, file_ids)
+        await self.db.generation_job.finish_job(job.id, JOB_STATUS_COMPLETED,
+                                                result=json.dumps(result_urls or file_ids))
+        self.counters.statistic(job.model_key, all_time=1, now_month=1)
+
+    async def _run(self, job: GenerationJob) -> list[str] | list[bytes]:
+        """Возвращает ссылки на результат, а для Sora — готовые изображения байтами."""
+        if job.model_key == 'Sora - Генерация изображений':
+            image_urls = json.loads(job.image_urls) if job.image_urls else []
+            return await generate_image(image_urls, job.prompt, self.usage, job.user_id)
+
+        if job.task_id and job.provider in self.router.providers:
+            provider, task_id, api_key = self.router.get(job.provider), job.task_id, job.provider_key
+            logging.info(f"Возобновляем ожидание задачи {task_id} у {provider.name} (задача очереди {job.id})")
+        else:
+            provider, task_id, api_key = await self.router.submit(job.model_key, json.loads(job.params))
+            await self.db.generation_job.set_task_id(job.id, provider.name, task_id, api_key)
+        return await self.router.wait(provider, job.model_key, task_id, api_key)
+
+    async def _deliver(self, job: GenerationJob, media: list[str] | list[bytes]) -> list[str]:
+        """
+        Отправляет результат пользователю. `media` — ссылки, file_id или изображения байтами.
+        Возвращает file_id отправленных файлов для кэша результатов.
+        """
+        if job.status_message_id:
+            try:
+                await self.bot.delete_message(chat_id=job.chat_id, message_id=job.status_message_id)
+            except Exception:
+                ...
+        safe_prompt = html.escape(job.prompt)
+
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text='⬅️ На главное меню', callback_data='back_main')]])
+        if job.model_key == 'Sora - Генерация изображений':
+            media_group = [
+                InputMediaPhoto(media=BufferedInputFile(item, filename=f'sora_{number}.png')
+                                if isinstance(item, bytes) else item)
+                for number, item in enumerate(media, start=1)
+            ]
+            media_group[0].caption = f"🖼️ <b>Готово!</b>\n<b>Промпт:</b> <code>{safe_prompt}</code>"
+            media_group[0].parse_mode = 'HTML'
+            message_to_copy = await self.bot.send_media_group(chat_id=job.chat_id, media=media_group)
+            # Копия в архив ссылается на уже загруженные в Telegram файлы, повторной загрузки нет
+            await self.bot.copy_messages(
+                chat_id=ARCHIVE_CHAT_ID,
+                from_chat_id=job.chat_id,
+                message_ids=[msg.message_id for msg in message_to_copy]
+            )
+            file_ids = [msg.photo[-1].file_id for msg in message_to_copy if msg.photo]
+        else:  # Для всех видеомоделей, включая Veo
+            caption = f"🎬 <b>Видео готово!</b>\n<b>Промпт:</b> <code>{safe_prompt}</code>\n<b>Модель:</b> {job.model_key}"
+            sent = await self.bot.send_video(chat_id=job.chat_id, video=media[0], caption=caption, parse_mode='HTML')
+            file_ids = [sent.video.file_id] if sent.video else []
+
+        await self.bot.send_message(job.chat_id, 'Вы можете вернуться на главное меню', reply_markup=keyboard)
+        return file_ids
+
+    async def cancel(self, job_id: int, user_id: int) -> bool:
+        """
+        Отмена задачи пользователем: останавливает ожидание результата, отменяет задачу у провайдера
+        (если он это поддерживает), освобождает слот модели и возвращает 💎.
+        Возвращает False, если отменять уже нечего (в том числе если результат уже доставляется).
+        """
+        job = await self.db.generation_job.cancel_job(job_id, user_id)
+        if job is None:
+            return False
+        # Отмену и возврат 💎 фиксируем в БД до любых внешних запросов (провайдер, Telegram)
+        await self._return_funds(job)
+
+        processing = self._active.get(job_id)
+        if processing is not None:
+            self._canceled.add(job_id)
+            processing.cancel()
+        if job.provider and job.task_id:
+            await self.router.cancel(job.provider, job.task_id, job.provider_key)
+
+        await self._notify_refund(job, "🚫 Генерация отменена.\n\nВаши 💎 возвращены на баланс.")
+        return True
+
+    async def _fail(self, job: GenerationJob, error: Exception) -> None:
+        """Помечает задачу проваленной и возвращает 💎. Возврат делается только один раз."""
+        if not await self.db.generation_job.finish_job(job.id, JOB_STATUS_FAILED, error=str(error)):
+            return
+        await self._refund(job, f"❌ <b>Ошибка:</b>\n<code>{html.escape(str(error))}</code>\n\nВаши 💎 возвращены на баланс.")
+
+    async def _refund(self, job: GenerationJob, text: str) -> None:
+        await self._return_funds(job)
+        await self._notify_refund(job, text)
+
+    async def _return_funds(self, job: GenerationJob) -> None:
+        # Возвращаем только то, что действительно списали: возврат ссылается на запись о списании
+        if job.debit_entry_id:
+            await self.db.user.refund_generation(job.user_id, job.cost, job.debit_entry_id)
+
+    async def _notify_refund(self, job: GenerationJob, text: str) -> None:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='⬅️ Назад', callback_data='back_main')]])
+        try:
+            try:
+                await self.bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.status_message_id,
+                                                 reply_markup=keyboard, parse_mode='HTML')
+            except Exception:
+                # Статусного сообщения может уже не быть (например, его удалили перед доставкой)
+                await self.bot.send_message(job.chat_id, text, reply_markup=keyboard, parse_mode='HTML')
+        except Exception as e:
+            logging.error(f"Не удалось сообщить пользователю {job.user_id} об ошибке задачи {job.id}: {e}")
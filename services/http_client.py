@@ -0,0 +1,95 @@
+# services/http_client.py
+import asyncio
+import logging
+
+import aiohttp
+
+from database.unit_of_work import commit_if_dirty
+from data.constants import (
+    HTTP_CONNECTIONS_LIMIT, HTTP_CONNECTIONS_PER_HOST, HTTP_KEEPALIVE_TIMEOUT, HTTP_DNS_CACHE_TTL,
+    HTTP_PROVIDER_TIMEOUTS, HTTP_WARMUP_URLS
+)
+
+
+class HTTPClientPool:
+    """
+    Реестр долгоживущих aiohttp-сессий для всех внешних провайдеров (Nexus, Replicate, ImgBB, Telegram).
+    Все сессии работают поверх одного коннектора, поэтому TCP/TLS-соединения и DNS-ответы
+    переиспользуются между запросами, а не открываются заново на каждый вызов.
+    Создается один раз в bot.py и прокидывается в хендлеры как `http`.
+    """
+
+    def __init__(
+            self,
+            limit: int = HTTP_CONNECTIONS_LIMIT,
+            limit_per_host: int = HTTP_CONNECTIONS_PER_HOST,
+            keepalive_timeout: float = HTTP_KEEPALIVE_TIMEOUT,
+            dns_cache_ttl: int = HTTP_DNS_CACHE_TTL,
+            timeouts: dict[str, tuple[float, float]] | None = None
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeouts = timeouts or HTTP_PROVIDER_TIMEOUTS
+        self._connector: aiohttp.TCPConnector | None = None
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+        # Перед запросом к провайдеру фиксируем записи апдейта: ответа можно ждать минуты
+        self._trace_config = aiohttp.TraceConfig()
+        self._trace_config.on_request_start.append(self._commit_before_request)
+
+    def _get_connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                ssl=False,
+            )
+        return self._connector
+
+    def session(self, provider: str) -> aiohttp.ClientSession:
+        """Возвращает сессию провайдера, создавая ее при первом обращении."""
+        session = self._sessions.get(provider)
+        if session is None or session.closed:
+            total, connect = self.timeouts.get(provider, (60, 10))
+            session = aiohttp.ClientSession(
+                connector=self._get_connector(),
+                connector_owner=False,
+                timeout=aiohttp.ClientTimeout(total=total, connect=connect),
+                trace_configs=[self._trace_config],
+            )
+            self._sessions[provider] = session
+        return session
+
+    @staticmethod
+    async def _commit_before_request(session, trace_config_ctx, params) -> None:
+        await commit_if_dirty()
+
+    async def warmup(self, urls: dict[str, str] | None = None) -> None:
+        """
+        Заранее открывает соединения к провайдерам, чтобы первые пользователи
+        после старта не платили за TCP/TLS-рукопожатие. Ошибки не критичны.
+        """
+        urls = urls or HTTP_WARMUP_URLS
+
+        async def _touch(provider: str, url: str):
+            try:
+                async with self.session(provider).head(url, allow_redirects=False) as resp:
+                    await resp.release()
+            except Exception as e:
+                logging.warning(f"Не удалось прогреть соединение с {provider} ({url}): {e}")
+
+        await asyncio.gather(*(_touch(provider, url) for provider, url in urls.items()))
+        logging.info("HTTP-пул прогрет.")
+
+    async def close(self) -> None:
+        """Закрывает все сессии и общий коннектор."""
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
+        self._sessions.clear()
+        if self._connector is not None and not self._connector.closed:
+            await self._connector.close()
+        self._connector = None
@@ -0,0 +1,155 @@
+# services/nexus_poller.py
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+import aiohttp
+
+from data.constants import (
+    NEXUS_POLL_INTERVALS, NEXUS_POLL_DEFAULT_INTERVAL, NEXUS_POLL_BACKOFF, NEXUS_POLL_TIMEOUT,
+    NEXUS_POLL_CONCURRENCY
+)
+from services.http_client import HTTPClientPool
+from services.nexus_api import get_nexus_task, parse_nexus_status
+
+
+@dataclass
+class _PendingTask:
+    task_id: str
+    model_name: str
+    future: asyncio.Future
+    registered_at: float = field(default_factory=time.monotonic)
+    next_poll_at: float = 0.0
+    in_flight: bool = False
+
+
+class NexusTaskPoller:
+    """
+    Единый опросчик статусов задач NexusAPI.
+    Вместо отдельного цикла sleep + GET на каждую генерацию задачи регистрируются здесь
+    и получают future, а один фоновый цикл проверяет только те задачи, которым подошел срок.
+    Интервал зависит от модели и растет с возрастом задачи.
+    """
+
+    def __init__(self, http: HTTPClientPool, timeout: float = NEXUS_POLL_TIMEOUT,
+                 concurrency: int = NEXUS_POLL_CONCURRENCY):
+        self.http = http
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: dict[str, _PendingTask] = {}
+        self._wakeup = asyncio.Event()
+        self._loop_task: asyncio.Task | None = None
+        self._requests: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        for request in list(self._requests):
+            request.cancel()
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.cancel()
+        self._pending.clear()
+
+    def register(self, task_id: str, model_name: str) -> asyncio.Future:
+        """
+        Ставит задачу на опрос и возвращает future с итоговым списком URL-ов.
+        Повторная регистрация той же задачи возвращает уже существующий future.
+        """
+        pending = self._pending.get(task_id)
+        if pending and not pending.future.done():
+            return pending.future
+
+        pending = _PendingTask(task_id, model_name, asyncio.get_running_loop().create_future())
+        pending.next_poll_at = pending.registered_at + self._intervals(model_name)[0]
+        self._pending[task_id] = pending
+        self._wakeup.set()
+        return pending.future
+
+    async def wait(self, task_id: str, model_name: str) -> list[str]:
+        """Регистрирует задачу и дожидается ее результата."""
+        return await self.register(task_id, model_name)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    @staticmethod
+    def _intervals(model_name: str) -> tuple[float, float, float]:
+        return NEXUS_POLL_INTERVALS.get(model_name, NEXUS_POLL_DEFAULT_INTERVAL)
+
+    def _next_interval(self, pending: _PendingTask, now: float) -> float:
+        _, base, maximum = self._intervals(pending.model_name)
+        age = now - pending.registered_at
+        return min(maximum, base + age * NEXUS_POLL_BACKOFF)
+
+    async def _run(self) -> None:
+        while True:
+            # Убираем задачи, которые больше никто не ждет (например, ожидание отменили)
+            for task_id in [t for t, p in self._pending.items() if p.future.done()]:
+                self._pending.pop(task_id, None)
+
+            self._wakeup.clear()
+            now = time.monotonic()
+            waiting = [p for p in self._pending.values() if not p.in_flight]
+            for pending in waiting:
+                if pending.next_poll_at <= now:
+                    # Запросы идут параллельно, чтобы один медленный ответ не задерживал остальные
+                    pending.in_flight = True
+                    request = asyncio.create_task(self._poll(pending))
+                    self._requests.add(request)
+                    request.add_done_callback(self._requests.discard)
+
+            sleep_for = min((p.next_poll_at for p in waiting if not p.in_flight), default=now + 60) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(sleep_for, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, pending: _PendingTask) -> None:
+        try:
+            await self._check(pending)
+        finally:
+            pending.in_flight = False
+            self._wakeup.set()
+
+    async def _check(self, pending: _PendingTask) -> None:
+        now = time.monotonic()
+        if now - pending.registered_at > self.timeout:
+            self._resolve(pending, error=RuntimeError("Тайм-аут ожидания генерации."))
+            return
+
+        try:
+            async with self._semaphore:
+                status_data = await get_nexus_task(self.http, pending.task_id)
+            result = parse_nexus_status(pending.task_id, status_data)
+        except aiohttp.ClientError as e:
+            logging.error(f"Сетевая ошибка при проверке статуса задачи {pending.task_id}: {e}")
+            result = None
+        except asyncio.TimeoutError:
+            logging.error(f"Тайм-аут запроса статуса задачи {pending.task_id}")
+            result = None
+        except Exception as e:
+            self._resolve(pending, error=e)
+            return
+
+        if result is not None:
+            self._resolve(pending, result=result)
+            return
+        pending.next_poll_at = time.monotonic() + self._next_interval(pending, now)
+
+    def _resolve(self, pending: _PendingTask, result: list[str] | None = None,
+                 error: Exception | None = None) -> None:
+        self._pending.pop(pending.task_id, None)
+        if pending.future.done():
+            return
+        if error is not None:
+            pending.future.set_exception(error)
+        else:
+            pending.future.set_result(result)
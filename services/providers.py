@@ -0,0 +1,255 @@
+# services/providers.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any
+
+from APIKeyManager.apikeymanager import APIKeyManager
+from data.constants import (
+    MODELS, REPLICATE_MODELS, MODEL_IMAGE_FIELD, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE,
+    BREAKER_OPEN_SECONDS, BREAKER_SLOW_CALL_SECONDS
+)
+from services.http_client import HTTPClientPool
+from services.nexus_api import submit_nexus_task
+from services.nexus_poller import NexusTaskPoller
+from services.replicate_api import build_replicate_input, create_replicate_prediction, wait_replicate_prediction, \
+    cancel_replicate_prediction
+from services.replicate_webhook import ReplicateWebhookReceiver
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Размыкается, когда среди последних вызовов слишком много ошибок или слишком медленных генераций.
+    Пока breaker разомкнут, запросы к провайдеру не отправляются. Через BREAKER_OPEN_SECONDS
+    пропускается один пробный вызов: успех замыкает breaker, ошибка снова размыкает.
+    """
+
+    def __init__(self, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 failure_rate: float = BREAKER_FAILURE_RATE, open_seconds: float = BREAKER_OPEN_SECONDS,
+                 slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._opened_at: float | None = None
+        self._trial_in_progress = False
+        self.last_latency: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return BREAKER_CLOSED
+        if time.monotonic() - self._opened_at >= self.open_seconds:
+            return BREAKER_HALF_OPEN
+        return BREAKER_OPEN
+
+    @property
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == BREAKER_CLOSED:
+            return True
+        if state == BREAKER_HALF_OPEN and not self._trial_in_progress:
+            return True
+        return False
+
+    def begin(self) -> None:
+        """Отмечает начало вызова; в полуоткрытом состоянии это и есть пробный вызов."""
+        if self.state == BREAKER_HALF_OPEN:
+            self._trial_in_progress = True
+
+    def release(self) -> None:
+        """Вызов прерван без результата (например, отменен пользователем) — пробный слот снова свободен."""
+        self._trial_in_progress = False
+
+    def record(self, success: bool, latency: float | None = None) -> None:
+        if latency is not None:
+            self.last_latency = latency
+            if latency > self.slow_call_seconds:
+                success = False
+        self._outcomes.append(success)
+
+        if self._opened_at is not None:
+            if self.state == BREAKER_HALF_OPEN or self._trial_in_progress:
+                self._trial_in_progress = False
+                if success:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                else:
+                    self._opened_at = time.monotonic()
+            return
+
+        if len(self._outcomes) >= self.min_calls and self.error_rate >= self.failure_rate:
+            self._opened_at = time.monotonic()
+
+
+class GenerationProvider:
+    """
+    Бэкенд генерации видео: запускает задачу и ждет ее результата по ID.
+    submit возвращает ID задачи и ключ API, которым она создана (если у провайдера несколько ключей, иначе None):
+    ключ хранится вместе с задачей и передается в wait и cancel.
+    """
+    name: str = ''
+
+    def supports(self, model_key: str) -> bool:
+        raise NotImplementedError
+
+    async def submit(self, model_key: str, params: dict[str, Any]) -> tuple[str, str | None]:
+        raise NotImplementedError
+
+    async def wait(self, model_key: str, task_id: str, api_key: str | None = None) -> list[str]:
+        raise NotImplementedError
+
+    async def cancel(self, task_id: str, api_key: str | None = None) -> None:
+        """Отмена задачи у провайдера. По умолчанию провайдер отмену не поддерживает."""
+        return None
+
+
+class NexusProvider(GenerationProvider):
+    name = 'nexus'
+
+    def __init__(self, http: HTTPClientPool, poller: NexusTaskPoller):
+        self.http = http
+        self.poller = poller
+
+    def supports(self, model_key: str) -> bool:
+        return model_key in MODELS
+
+    async def submit(self, model_key: str, params: dict[str, Any]) -> tuple[str, str | None]:
+        return await submit_nexus_task(self.http, params), None
+
+    async def wait(self, model_key: str, task_id: str, api_key: str | None = None) -> list[str]:
+        return await self.poller.wait(task_id, MODELS[model_key])
+
+
+class ReplicateProvider(GenerationProvider):
+    name = 'replicate'
+
+    def __init__(self, http: HTTPClientPool, key_manager: APIKeyManager,
+                 webhook: ReplicateWebhookReceiver | None = None):
+        self.http = http
+        self.key_manager = key_manager
+        self.webhook = webhook
+
+    def supports(self, model_key: str) -> bool:
+        return model_key in REPLICATE_MODELS
+
+    async def submit(self, model_key: str, params: dict[str, Any]) -> tuple[str, str | None]:
+        # Параметры собраны под NexusAPI, переводим их во вход Replicate
+        input_dict = build_replicate_input(
+            model_key, params['prompt'], params.get('aspect_ratio'), params.get('duration')
+        )
+        image_field = MODEL_IMAGE_FIELD.get(model_key)
+        if image_field and params.get(image_field):
+            input_dict[image_field] = params[image_field]
+        prediction, api_key = await create_replicate_prediction(self.http, self.key_manager, model_key, input_dict,
+                                                                self.webhook)
+        return prediction['id'], api_key
+
+    async def wait(self, model_key: str, task_id: str, api_key: str | None = None) -> list[str]:
+        output = await wait_replicate_prediction(self.http, self.key_manager, task_id, self.webhook, api_key)
+        return [output]
+
+    async def cancel(self, task_id: str, api_key: str | None = None) -> None:
+        await cancel_replicate_prediction(self.http, self.key_manager, task_id, api_key)
+
+
+class ProviderRouter:
+    """
+    Выбирает провайдера для модели с учетом circuit breaker'ов: отдельный breaker на провайдера
+    и на пару провайдер+модель. Пока breaker основного провайдера разомкнут, совместимые модели
+    автоматически уходят к следующему.
+    """
+
+    def __init__(self, providers: list[GenerationProvider]):
+        self.providers = {provider.name: provider for provider in providers}
+        self._order = [provider.name for provider in providers]
+        self._breakers: dict[tuple[str, str | None], CircuitBreaker] = {}
+
+    def breaker(self, provider_name: str, model_key: str | None = None) -> CircuitBreaker:
+        key = (provider_name, model_key)
+        if key not in self._breakers:
+            self._breakers[key] = CircuitBreaker()
+        return self._breakers[key]
+
+    def get(self, provider_name: str) -> GenerationProvider:
+        return self.providers[provider_name]
+
+    def _allowed(self, provider: GenerationProvider, model_key: str) -> bool:
+        return (provider.supports(model_key)
+                and self.breaker(provider.name).allow()
+                and self.breaker(provider.name, model_key).allow())
+
+    def _record(self, provider: GenerationProvider, model_key: str, success: bool,
+                latency: float | None = None) -> None:
+        self.breaker(provider.name).record(success, latency)
+        self.breaker(provider.name, model_key).record(success, latency)
+
+    async def submit(self, model_key: str, params: dict[str, Any]) -> tuple[GenerationProvider, str, str | None]:
+        """Запускает задачу у первого доступного провайдера; при ошибке запуска пробует следующего."""
+        last_error: Exception | None = None
+        for name in self._order:
+            provider = self.providers[name]
+            if not self._allowed(provider, model_key):
+                continue
+            self.breaker(provider.name).begin()
+            self.breaker(provider.name, model_key).begin()
+            try:
+                task_id, api_key = await provider.submit(model_key, params)
+                return provider, task_id, api_key
+            except Exception as e:
+                self._record(provider, model_key, False)
+                logging.warning(f"Провайдер {provider.name} не принял задачу модели {model_key}: {e}")
+                last_error = e
+        if last_error is not None:
+            raise last_error
+        raise RuntimeError("Все провайдеры для этой модели временно недоступны, попробуйте позже.")
+
+    async def wait(self, provider: GenerationProvider, model_key: str, task_id: str,
+                   api_key: str | None = None) -> list[str]:
+        started = time.monotonic()
+        try:
+            result = await provider.wait(model_key, task_id, api_key)
+        except asyncio.CancelledError:
+            self.breaker(provider.name).release()
+            self.breaker(provider.name, model_key).release()
+            raise
+        except Exception:
+            self._record(provider, model_key, False)
+            raise
+        self._record(provider, model_key, True, time.monotonic() - started)
+        return result
+
+    async def cancel(self, provider_name: str, task_id: str, api_key: str | None = None) -> None:
+        provider = self.providers.get(provider_name)
+        if provider is None:
+            return
+        try:
+            await provider.cancel(task_id, api_key)
+        except Exception as e:
+            logging.warning(f"Не удалось отменить задачу {task_id} у {provider_name}: {e}")
+
+    def states(self) -> list[dict[str, Any]]:
+        """Состояние всех breaker'ов для админки."""
+        return [
+            {
+                'provider': provider_name,
+                'model': model_key,
+                'state': breaker.state,
+                'error_rate': round(breaker.error_rate * 100),
+                'last_latency': round(breaker.last_latency) if breaker.last_latency is not None else None,
+            }
+            for (provider_name, model_key), breaker in sorted(
+                self._breakers.items(), key=lambda item: (item[0][0], item[0][1] or '')
+            )
+        ]
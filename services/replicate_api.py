@@ -1,84 +1,127 @@
 # services/replicate_api.py
 import logging
 import asyncio
+from typing import Any
+
 import aiohttp
 from APIKeyManager.apikeymanager import APIKeyManager
-from data.constants import MODELS, ASPECT_INPUTS, MODEL_IMAGE_FIELD
-from utils.helpers import _image_to_data_uri
+from services.http_client import HTTPClientPool
+from services.replicate_webhook import ReplicateWebhookReceiver
+from data.constants import REPLICATE_MODELS, ASPECT_INPUTS, REPLICATE_WEBHOOK_DEADLINE
 
-async def generate_replicate_async(
-        key_manager: APIKeyManager, model: str, prompt: str, aspect_ratio: str = "16:9",
-        duration: str = '5 сек', pixverse_mode: str | None = None, image_path: str | None = None
-) -> str:
-    if model not in MODELS:
-        raise ValueError(f"Модель '{model}' не найдена в списке поддерживаемых.")
+REPLICATE_PREDICTIONS_URL = "https://api.replicate.com/v1/predictions"
 
-    model_handle = MODELS[model]
+
+def build_replicate_input(model: str, prompt: str, aspect_ratio: str | None = "16:9",
+                          duration: str | int | None = '5 сек', pixverse_mode: str | None = None) -> dict[str, Any]:
     input_dict = {"prompt": prompt}
 
     if aspect_ratio in ASPECT_INPUTS:
         input_dict["aspect_ratio"] = ASPECT_INPUTS[aspect_ratio]
-    try:
-        input_dict["duration"] = int(duration.replace(" сек", ""))
-    except (ValueError, AttributeError):
-        pass
+    if isinstance(duration, int):
+        input_dict["duration"] = duration
+    else:
+        try:
+            input_dict["duration"] = int(duration.replace(" сек", ""))
+        except (ValueError, AttributeError):
+            pass
     if model == "Pixverse v4.5" and pixverse_mode:
         input_dict["mode"] = pixverse_mode
-    if image_path and model in MODEL_IMAGE_FIELD:
-        logging.info(f"Кодирование изображения {image_path} в Data URI...")
-        input_dict[MODEL_IMAGE_FIELD[model]] = _image_to_data_uri(image_path)
-
-    payload = {"version": model_handle, "input": input_dict}
-    base_url = "https://api.replicate.com/v1/predictions"
-    prediction_data = None
-    working_headers = None
-
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-
-        for attempt in range(2):
-            current_key = await key_manager.get_key()
-            headers = {"Authorization": f"Bearer {current_key}", "Content-Type": "application/json"}
-
-            try:
-                logging.info(f"Отправка запроса на генерацию с ключом {current_key[:8]}...")
-                async with session.post(base_url, headers=headers, json=payload, timeout=60) as resp:
-                    if resp.status == 402:
-                        await key_manager.report_key_exhausted(current_key)
-                        if attempt == 1:
-                            raise RuntimeError("402: Все доступные ключи API исчерпали свою квоту.")
-                        continue
-
-                    resp.raise_for_status()
-                    prediction_data = await resp.json()
-                    working_headers = headers
-                    logging.info(f"Задача успешно создана, ID: {prediction_data.get('id')}")
-                    break
-
-            except aiohttp.ClientError as e:
-                logging.error(f"Сетевая ошибка при вызове Replicate API: {e}")
-                raise RuntimeError(f"Сетевая ошибка при обращении к API: {e}")
-
-        if not prediction_data or not working_headers:
-            raise RuntimeError("Не удалось создать задачу генерации видео после всех попыток.")
-
-        # Если результат уже есть в первом ответе
-        if output := prediction_data.get("output"):
-            return output[0] if isinstance(output, list) else output
-
-        # Опрос статуса
-        status_url = prediction_data['urls']['get']
-        for _ in range(60):
-            await asyncio.sleep(60)
-            async with session.get(status_url, headers=working_headers, timeout=30) as st_resp:
-                st_resp.raise_for_status()
-                status_json = await st_resp.json()
-
-            if status_json.get("status") == "succeeded":
-                output = status_json.get("output")
-                return output[0] if isinstance(output, list) else output
-
-            if status_json.get("status") in ("failed", "canceled"):
-                error_detail = status_json.get("error")
-                raise RuntimeError(f"Генерация провалилась: {error_detail}")
-
-        raise RuntimeError("Тайм-аут ожидания генерации видео.")
\ No newline at end of file
+    return input_dict
+
+
+async def create_replicate_prediction(
+        http: HTTPClientPool, key_manager: APIKeyManager, model: str, input_dict: dict[str, Any],
+        webhook: ReplicateWebhookReceiver | None = None
+) -> tuple[dict[str, Any], str]:
+    """
+    Создает предсказание на Replicate, при исчерпании квоты ключа переключается на следующий.
+    Возвращает ответ Replicate и ключ, которым создано предсказание: опрашивать и отменять его
+    можно только этим ключом, даже если менеджер ключей уже переключился на другой.
+    """
+    if model not in REPLICATE_MODELS:
+        raise ValueError(f"Модель '{model}' не найдена в списке поддерживаемых.")
+
+    payload = {"version": REPLICATE_MODELS[model], "input": input_dict}
+    if webhook:
+        # Replicate сам сообщит о завершении, опрос статуса останется только запасным вариантом
+        payload["webhook"] = webhook.url
+        payload["webhook_events_filter"] = ["completed"]
+
+    session = http.session('replicate')
+    for attempt in range(2):
+        current_key = await key_manager.get_key()
+        headers = {"Authorization": f"Bearer {current_key}", "Content-Type": "application/json"}
+
+        try:
+            logging.info(f"Отправка запроса на генерацию с ключом {current_key[:8]}...")
+            async with session.post(REPLICATE_PREDICTIONS_URL, headers=headers, json=payload) as resp:
+                if resp.status == 402:
+                    await key_manager.report_key_exhausted(current_key)
+                    if attempt == 1:
+                        raise RuntimeError("402: Все доступные ключи API исчерпали свою квоту.")
+                    continue
+
+                resp.raise_for_status()
+                prediction_data = await resp.json()
+                logging.info(f"Задача успешно создана, ID: {prediction_data.get('id')}")
+                return prediction_data, current_key
+
+        except aiohttp.ClientError as e:
+            logging.error(f"Сетевая ошибка при вызове Replicate API: {e}")
+            raise RuntimeError(f"Сетевая ошибка при обращении к API: {e}")
+
+    raise RuntimeError("Не удалось создать задачу генерации видео после всех попыток.")
+
+
+async def wait_replicate_prediction(
+        http: HTTPClientPool, key_manager: APIKeyManager, prediction_id: str,
+        webhook: ReplicateWebhookReceiver | None = None, api_key: str | None = None
+) -> str:
+    """
+    Ожидает завершения предсказания: сначала вебхук (если включен), затем опрос статуса.
+    Можно вызывать повторно для уже созданного предсказания.
+    api_key — ключ, которым создано предсказание; без него берется текущий ключ менеджера.
+    """
+    if webhook:
+        try:
+            status_json = await asyncio.wait_for(webhook.expect(prediction_id), timeout=REPLICATE_WEBHOOK_DEADLINE)
+            return _prediction_output(status_json)
+        except asyncio.TimeoutError:
+            logging.warning(f"Вебхук для предсказания {prediction_id} не пришел, переходим на опрос статуса.")
+        finally:
+            webhook.discard(prediction_id)
+
+    # Опрос статуса
+    session = http.session('replicate')
+    status_url = f"{REPLICATE_PREDICTIONS_URL}/{prediction_id}"
+    for _ in range(60):
+        await asyncio.sleep(60)
+        headers = {"Authorization": f"Bearer {api_key or await key_manager.get_key()}"}
+        async with session.get(status_url, headers=headers) as st_resp:
+            st_resp.raise_for_status()
+            status_json = await st_resp.json()
+
+        if status_json.get("status") in ("succeeded", "failed", "canceled"):
+            return _prediction_output(status_json)
+
+    raise RuntimeError("Тайм-аут ожидания генерации видео.")
+
+
+async def cancel_replicate_prediction(http: HTTPClientPool, key_manager: APIKeyManager, prediction_id: str,
+                                      api_key: str | None = None) -> None:
+    """Отменяет предсказание, чтобы оно не расходовало мощности и квоту ключа."""
+    headers = {"Authorization": f"Bearer {api_key or await key_manager.get_key()}"}
+    cancel_url = f"{REPLICATE_PREDICTIONS_URL}/{prediction_id}/cancel"
+    async with http.session('replicate').post(cancel_url, headers=headers) as resp:
+        resp.raise_for_status()
+    logging.info(f"Предсказание {prediction_id} отменено.")
+
+
+def _prediction_output(status_json: dict) -> str:
+    """Достает результат из завершенного предсказания или бросает ошибку, если оно провалилось."""
+    if status_json.get("status") == "succeeded":
+        output = status_json.get("output")
+        return output[0] if isinstance(output, list) else output
+    error_detail = status_json.get("error")
+    raise RuntimeError(f"Генерация провалилась: {error_detail}")
@@ -0,0 +1,131 @@
+# services/replicate_webhook.py
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any
+
+from aiohttp import web
+
+from data.constants import REPLICATE_WEBHOOK_PATH, REPLICATE_WEBHOOK_TOLERANCE
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+def signature_for(secret: str, webhook_id: str, timestamp: str, body: bytes) -> str:
+    """
+    Подпись вебхука в формате Replicate: base64(HMAC-SHA256("{id}.{timestamp}.{body}")).
+    Ключ — base64-часть секрета после префикса `whsec_`.
+    """
+    key = base64.b64decode(secret.split('_', 1)[1] if secret.startswith('whsec_') else secret)
+    signed_content = f"{webhook_id}.{timestamp}.".encode() + body
+    digest = hmac.new(key, signed_content, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def verify_signature(secret: str, headers: Any, body: bytes,
+                     tolerance: float = REPLICATE_WEBHOOK_TOLERANCE) -> bool:
+    """Проверяет заголовки webhook-id / webhook-timestamp / webhook-signature."""
+    webhook_id = headers.get('webhook-id')
+    timestamp = headers.get('webhook-timestamp')
+    signatures = headers.get('webhook-signature')
+    if not (webhook_id and timestamp and signatures):
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except ValueError:
+        return False
+
+    expected = signature_for(secret, webhook_id, timestamp, body)
+    for item in signatures.split():
+        _, _, signature = item.partition(',')
+        if hmac.compare_digest(signature, expected):
+            return True
+    return False
+
+
+class ReplicateWebhookReceiver:
+    """
+    Небольшой aiohttp-сервер внутри процесса бота, принимающий вебхуки Replicate.
+    ReplicateProvider передает его URL при создании предсказания и ждет future,
+    который разрешается сразу, как только Replicate сообщит о завершении.
+    """
+
+    def __init__(self, public_url: str, secret: str, host: str = '0.0.0.0', port: int = 8080,
+                 path: str = REPLICATE_WEBHOOK_PATH, early_results_limit: int = 1000):
+        self.url = public_url.rstrip('/') + path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.path = path
+        self._waiters: dict[str, asyncio.Future] = {}
+        # Вебхук может прийти раньше, чем мы начали его ждать — храним такие ответы недолго
+        self._early_results: OrderedDict[str, dict] = OrderedDict()
+        self._early_results_limit = early_results_limit
+        self._runner: web.AppRunner | None = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        return app
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logging.info(f"Приемник вебхуков Replicate слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        for future in self._waiters.values():
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+
+    def expect(self, prediction_id: str) -> asyncio.Future:
+        """Возвращает future, который получит итоговый JSON предсказания."""
+        future = asyncio.get_running_loop().create_future()
+        early = self._early_results.pop(prediction_id, None)
+        if early is not None:
+            future.set_result(early)
+        else:
+            self._waiters[prediction_id] = future
+        return future
+
+    def discard(self, prediction_id: str) -> None:
+        """Перестает ждать вебхук для предсказания (результат получен иначе или ожидание отменено)."""
+        future = self._waiters.pop(prediction_id, None)
+        if future and not future.done():
+            future.cancel()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if not verify_signature(self.secret, request.headers, body):
+            logging.warning("Отклонен вебхук Replicate с неверной подписью.")
+            return web.Response(status=401)
+
+        try:
+            prediction = json.loads(body)
+            prediction_id = prediction['id']
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        if prediction.get('status') not in TERMINAL_STATUSES:
+            return web.Response(status=200)
+
+        future = self._waiters.pop(prediction_id, None)
+        if future is None:
+            self._early_results[prediction_id] = prediction
+            while len(self._early_results) > self._early_results_limit:
+                self._early_results.popitem(last=False)
+        elif not future.done():
+            future.set_result(prediction)
+        return web.Response(status=200)
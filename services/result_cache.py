@@ -0,0 +1,76 @@
+# services/result_cache.py
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from data.constants import MODEL_IMAGE_FIELD, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+
+
+@dataclass(frozen=True)
+class CachedResult:
+    urls: tuple[str, ...]
+    file_ids: tuple[str, ...]  # file_id уже отправленных в Telegram медиа, повторная отправка не качает файл заново
+    created_at: float
+
+
+def generation_cache_key(params: dict[str, Any], image_hashes: list[str]) -> str:
+    """
+    Канонический хэш запроса на генерацию.
+    Ссылки на фото-референсы каждый раз новые, поэтому вместо них в ключ идут хэши содержимого фото.
+    """
+    image_fields = set(MODEL_IMAGE_FIELD.values())
+    canonical = {key: value for key, value in params.items() if key not in image_fields}
+    canonical['images'] = list(image_hashes)
+    payload = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Кэш результатов генераций в памяти с TTL и вытеснением давно не использованных записей (LRU).
+    Повторный запрос с теми же параметрами отдается из кэша без обращения к провайдеру.
+    """
+
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[str, CachedResult] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str | None) -> CachedResult | None:
+        if not key:
+            return None
+        item = self._items.get(key)
+        if item is None or time.monotonic() - item.created_at > self.ttl:
+            self._items.pop(key, None)
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, key: str | None, urls: list[str], file_ids: list[str]) -> None:
+        """Ссылки кладутся сразу после генерации, file_id добавляются после доставки."""
+        if not key or not (urls or file_ids):
+            return
+        self._items[key] = CachedResult(tuple(urls), tuple(file_ids), time.monotonic())
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, key: str | None) -> None:
+        if key:
+            self._items.pop(key, None)
+
+    def stats(self) -> dict[str, int]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits * 100 / total) if total else 0,
+        }
@@ -0,0 +1,64 @@
+# services/upload_cache.py
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+
+from database.database import Database
+from data.constants import UPLOAD_CACHE_SIZE, UPLOAD_CACHE_TTL
+
+
+@dataclass(frozen=True)
+class CachedUpload:
+    url: str
+    content_hash: str
+    created_at: float  # time.time() момента загрузки
+
+
+class UploadCache:
+    """
+    Кэш загрузок на ImgBB: file_unique_id фото (с профилем подготовки) или хэш содержимого -> ссылка.
+    Горячие записи держатся в памяти (LRU), все остальные — в таблице image_uploads.
+    Повторно отправленное фото не скачивается из Telegram и не загружается заново.
+    """
+
+    def __init__(self, db: Database, max_size: int = UPLOAD_CACHE_SIZE, ttl: float = UPLOAD_CACHE_TTL):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[str, CachedUpload] = OrderedDict()
+
+    @staticmethod
+    def file_key(file_unique_id: str, profile: str) -> str:
+        return f"file:{file_unique_id}:{profile}"
+
+    @staticmethod
+    def hash_key(content_hash: str) -> str:
+        return f"sha256:{content_hash}"
+
+    async def get(self, key: str) -> CachedUpload | None:
+        item = self._items.get(key)
+        if item is not None:
+            if time.time() - item.created_at <= self.ttl:
+                self._items.move_to_end(key)
+                return item
+            self._items.pop(key, None)
+
+        row = await self.db.image_upload.get(key, timedelta(seconds=self.ttl))
+        if row is None:
+            return None
+        item = CachedUpload(row.url, row.content_hash, row.created_at.timestamp())
+        self._remember(key, item)
+        return item
+
+    async def put(self, keys: list[str], url: str, content_hash: str) -> None:
+        item = CachedUpload(url, content_hash, time.time())
+        for key in keys:
+            self._remember(key, item)
+            await self.db.image_upload.save(key, url, content_hash)
+
+    def _remember(self, key: str, item: CachedUpload) -> None:
+        self._items[key] = item
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
@@ -0,0 +1,64 @@
+# services/usage.py
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Any
+
+from database.database import Database
+from data.constants import USAGE_BUFFER_SIZE, USAGE_FLUSH_INTERVAL
+
+
+class UsageRecorder:
+    """
+    Учет расхода токенов OpenAI. Запрос только кладет событие в кольцевой буфер в памяти,
+    а фоновая задача раз в USAGE_FLUSH_INTERVAL записывает накопленное в usage_events одной пачкой.
+    """
+
+    def __init__(self, db: Database, capacity: int = USAGE_BUFFER_SIZE, flush_interval: float = USAGE_FLUSH_INTERVAL):
+        self.db = db
+        self.flush_interval = flush_interval
+        self._buffer: deque[dict[str, Any]] = deque(maxlen=capacity)
+        self._task: asyncio.Task | None = None
+
+    def record(self, user_id: int | None, model: str, prompt_tokens: int, completion_tokens: int,
+               latency: float) -> None:
+        if len(self._buffer) == self._buffer.maxlen:
+            logging.warning("Буфер учета токенов переполнен, самое старое событие потеряно.")
+        self._buffer.append({
+            'user_id': user_id,
+            'model': model,
+            'prompt_tokens': prompt_tokens or 0,
+            'completion_tokens': completion_tokens or 0,
+            'latency_ms': round(latency * 1000),
+            'created_at': datetime.now(),
+        })
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        events = list(self._buffer)
+        if not events:
+            return
+        self._buffer.clear()
+        try:
+            await self.db.usage.add_many(events)
+        except Exception as e:
+            logging.error(f"Не удалось записать {len(events)} событий учета токенов: {e}")
+            # Возвращаем события в начало буфера (сколько влезет), запишем при следующей попытке
+            free = self._buffer.maxlen - len(self._buffer)
+            if free:
+                self._buffer.extendleft(reversed(events[-free:]))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
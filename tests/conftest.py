@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py не хранится в репозитории (в нем токены). Для тестов хватает заглушки с нужными полями.
+try:
+    import config  # noqa: F401
+except ImportError:
+    config = types.ModuleType('config')
+    config.IMGBB_API_KEY = 'test'
+    sys.modules['config'] = config
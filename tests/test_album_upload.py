@@ -0,0 +1,94 @@
+"""
+Загрузка альбома на ImgBB против локального заменителя ImgBB (aiohttp-сервер с искусственной задержкой).
+Проверяет, что фото обрабатываются параллельно, порядок сохраняется, а упавшее фото попадает в failed.
+"""
+import asyncio
+import logging
+import time
+from types import SimpleNamespace
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+web = pytest.importorskip('aiohttp.web')
+pytest.importorskip('aiogram')
+pytest.importorskip('PIL')
+
+import config  # noqa: E402
+from services.http_client import HTTPClientPool  # noqa: E402
+from utils import helpers  # noqa: E402
+from data.constants import IMAGE_UPLOAD_CONCURRENCY  # noqa: E402
+
+UPLOAD_DELAY = 0.2  # Сколько "ImgBB" отвечает на одну загрузку, сек.
+DOWNLOAD_DELAY = 0.05  # Сколько "Telegram" отдает одно фото, сек.
+
+
+class FakeBot:
+    async def download(self, file, destination):
+        await asyncio.sleep(DOWNLOAD_DELAY)
+        destination.write(b'\xff\xd8' + file.encode() + b'\xff\xd9')
+
+
+def make_album(count: int) -> list[SimpleNamespace]:
+    return [
+        SimpleNamespace(photo=[SimpleNamespace(file_id=f'file{number}', file_unique_id=f'unique{number}',
+                                               file_size=1024)])
+        for number in range(1, count + 1)
+    ]
+
+
+async def start_imgbb_stub(fail_names: set[str] = frozenset()) -> tuple[web.AppRunner, str]:
+    async def upload(request: web.Request) -> web.Response:
+        form = await request.post()
+        image = form['image']
+        await asyncio.sleep(UPLOAD_DELAY)
+        if any(name in image.filename for name in fail_names):
+            return web.json_response({'error': 'stub failure'}, status=500)
+        return web.json_response({'data': {'url': f'https://i.ibb.co/{image.filename}'}})
+
+    app = web.Application()
+    app.router.add_post('/1/upload', upload)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/1/upload'
+
+
+async def upload_album(count: int, fail_names: set[str] = frozenset()):
+    runner, url = await start_imgbb_stub(fail_names)
+    http = HTTPClientPool()
+    try:
+        helpers.IMGBB_UPLOAD_URL = url
+        started = time.perf_counter()
+        result = await helpers.download_and_upload_images(http, FakeBot(), make_album(count))
+        return result, time.perf_counter() - started
+    finally:
+        await http.close()
+        await runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def imgbb_settings(monkeypatch):
+    monkeypatch.setattr(config, 'IMGBB_API_KEY', 'test', raising=False)
+    monkeypatch.setattr(helpers, 'IMGBB_UPLOAD_URL', helpers.IMGBB_UPLOAD_URL)
+
+
+def test_album_latency_is_bounded_by_concurrency():
+    count = 8
+    result, elapsed = asyncio.run(upload_album(count))
+
+    sequential = count * (UPLOAD_DELAY + DOWNLOAD_DELAY)
+    waves = -(-count // IMAGE_UPLOAD_CONCURRENCY)
+    logging.debug(f"Альбом из {count} фото: {elapsed:.2f} сек (последовательно было бы {sequential:.2f} сек)")
+    assert not result.failed
+    assert elapsed < waves * (UPLOAD_DELAY + DOWNLOAD_DELAY) + 0.5
+    assert elapsed < sequential
+
+
+def test_album_keeps_order_and_reports_failed_photos():
+    result, _ = asyncio.run(upload_album(4, fail_names={'unique2'}))
+
+    assert result.failed == [2]
+    assert [image.url.rsplit('/', 1)[1].split('.')[0] for image in result.images] == ['unique1', 'unique3', 'unique4']
@@ -0,0 +1,77 @@
+"""
+Приемник вебхуков Replicate против локального "Replicate": тест сам подписывает и отправляет предсказания.
+"""
+import asyncio
+import base64
+import json
+import socket
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from services.replicate_webhook import ReplicateWebhookReceiver, signature_for  # noqa: E402
+
+SECRET = 'whsec_' + base64.b64encode(b'test-webhook-secret').decode()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def signed_headers(body: bytes, secret: str = SECRET, timestamp: int | None = None) -> dict[str, str]:
+    webhook_id = 'msg_1'
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    return {
+        'webhook-id': webhook_id,
+        'webhook-timestamp': timestamp,
+        'webhook-signature': f"v1,{signature_for(secret, webhook_id, timestamp, body)}",
+        'Content-Type': 'application/json',
+    }
+
+
+async def with_receiver(scenario):
+    port = free_port()
+    receiver = ReplicateWebhookReceiver(f'http://127.0.0.1:{port}', SECRET, host='127.0.0.1', port=port)
+    await receiver.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            await scenario(receiver, session)
+    finally:
+        await receiver.stop()
+
+
+def test_signed_webhook_resolves_expected_prediction():
+    async def scenario(receiver: ReplicateWebhookReceiver, session):
+        future = receiver.expect('pred1')
+        payload = {'id': 'pred1', 'status': 'succeeded', 'output': ['https://replicate.delivery/result.mp4']}
+        body = json.dumps(payload).encode()
+
+        async with session.post(receiver.url, data=body, headers=signed_headers(body)) as response:
+            assert response.status == 200
+
+        assert await asyncio.wait_for(future, timeout=1) == payload
+
+    asyncio.run(with_receiver(scenario))
+
+
+@pytest.mark.parametrize('headers_for', [
+    lambda body: signed_headers(body, secret='whsec_' + base64.b64encode(b'other-secret').decode()),
+    lambda body: signed_headers(body, timestamp=int(time.time()) - 3600),
+    lambda body: {**signed_headers(body), 'webhook-signature': 'v1,broken'},
+], ids=['wrong-secret', 'stale-timestamp', 'bad-signature'])
+def test_rejected_webhook_leaves_future_pending(headers_for):
+    async def scenario(receiver: ReplicateWebhookReceiver, session):
+        future = receiver.expect('pred2')
+        body = json.dumps({'id': 'pred2', 'status': 'succeeded', 'output': []}).encode()
+
+        async with session.post(receiver.url, data=body, headers=headers_for(body)) as response:
+            assert response.status == 401
+
+        await asyncio.sleep(0.05)
+        assert not future.done()
+
+    asyncio.run(with_receiver(scenario))
@@ -1,13 +1,16 @@
-import os
+import asyncio
 
 import httpx
 import base64
 import random
 import string
+import time
+from typing import AsyncIterator
 
 from openai import AsyncOpenAI
 
-from utils.helpers import upload_image_to_imgbb
+from data.constants import GPT_CHAT_MODEL
+from services.usage import UsageRecorder
 
 import config
 
@@ -26,56 +29,71 @@ client = AsyncOpenAI(
 )
 
 
-async def get_assistant_and_thread(model: str = 'gpt-4.1-mini', role: str = None):
+async def get_text_answer(messages: list[dict[str, str]], model: str = GPT_CHAT_MODEL,
+                          usage: UsageRecorder | None = None, user_id: int | None = None) -> str | None:
     """
-    :param role: Роль которую будет отыгрывать ИИ.
-    :param model: модель чата гпт
-    :return: Две str переменной по факту являющиеся уникальными для каждого юзера, чтобы обрабатывать их
-        диалог отдельно от других юзеров
+    Ответ ИИ на диалог одним запросом chat.completions.
+    История диалога хранится у нас (DialogStore), поэтому ассистенты и треды OpenAI не создаются.
     """
-    assistant = await client.beta.assistants.create(
+    started = time.monotonic()
+    response = await client.chat.completions.create(
         model=model,
-        instructions=role if role else None,
-        temperature=1.0,
-        name="Яна"
+        messages=messages,
+        temperature=1.0
     )
+    if usage and response.usage:
+        usage.record(user_id, model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                     time.monotonic() - started)
+    return response.choices[0].message.content
 
-    thread = await client.beta.threads.create()
-    return assistant.id, thread.id
 
+async def stream_text_answer(messages: list[dict[str, str]], model: str = GPT_CHAT_MODEL,
+                             usage: UsageRecorder | None = None, user_id: int | None = None) -> AsyncIterator[str]:
+    """То же, что get_text_answer, но отдает ответ по частям по мере генерации."""
+    started = time.monotonic()
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=1.0,
+        stream=True,
+        stream_options={'include_usage': True}
+    )
+    async for chunk in stream:
+        if usage and chunk.usage:
+            usage.record(user_id, model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens,
+                         time.monotonic() - started)
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def summarize_dialog(summary: str | None, messages: list[dict[str, str]], model: str = GPT_CHAT_MODEL,
+                           usage: UsageRecorder | None = None) -> str:
+    """Сворачивает старую часть диалога в краткое содержание, чтобы история укладывалась в бюджет токенов."""
+    started = time.monotonic()
+    dialog = '\n'.join(f"{message['role']}: {message['content']}" for message in messages)
+    if summary:
+        dialog = f"Предыдущее краткое содержание: {summary}\n\n{dialog}"
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {'role': 'system', 'content': 'Кратко перескажи диалог пользователя с ассистентом: факты, договоренности '
+                                          'и контекст, нужные для продолжения разговора. Не больше 10 предложений.'},
+            {'role': 'user', 'content': dialog},
+        ],
+        temperature=0.3
+    )
+    if usage and response.usage:
+        usage.record(None, model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                     time.monotonic() - started)
+    return response.choices[0].message.content or summary or ''
 
-async def get_text_answer(text: str, assistant_id: str, thread_id: str) -> str | None:
+
+async def generate_image(photos: list[str], prompt: str, usage: UsageRecorder | None = None,
+                         user_id: int | None = None) -> list[bytes]:
     """
-        Обработка ИИшкой сообщения юзера, возвращает ответ ИИ
+    Генерирует изображения и возвращает их байтами: их можно сразу отправить в Telegram,
+    без промежуточной загрузки на хостинг.
     """
-    message = await client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=text
-    )
-    run = await client.beta.threads.runs.create_and_poll(
-        thread_id=thread_id,
-        assistant_id=assistant_id
-    )
-    info = (f'Стоимость запроса: {run.usage.completion_tokens}\nСтоимость промпта: {run.usage.prompt_tokens}'
-            f'\nОбщая стоимость: {run.usage.total_tokens}')
-    with open('upload.txt', 'a', encoding='utf-8') as file:
-        file.write('Запрос на диалог: ' + info + '\n\n')
-    print(info)
-    print(run)
-    print(run.status)
-    if run.status == "completed":
-        messages = await client.beta.threads.messages.list(thread_id=thread_id)
-        #print(messages)
-
-        async for message in messages:
-            print(message.content[0].text.value)
-            return message.content[0].text.value
-    else:
-        return None
-
-
-async def generate_image(photos: list[str], prompt: str) -> list[str]:
     photos_data = []
     for photo in photos:
         photos_data.append(
@@ -85,7 +103,7 @@ async def generate_image(photos: list[str], prompt: str) -> list[str]:
             }
         )
     try:
-
+        started = time.monotonic()
         response = await client.responses.create(
             model="gpt-4o-mini",
             input=[
@@ -99,31 +117,17 @@ async def generate_image(photos: list[str], prompt: str) -> list[str]:
             ],
             tools=[{"type": "image_generation", "input_fidelity": "low"}],
         )
-        info = f'Общая стоимость: {response.usage.total_tokens}'
-        with open('upload.txt', 'a', encoding='utf-8') as file:
-            file.write('Запрос на генерацию: ' + info + '\n\n')
+        if usage and response.usage:
+            usage.record(user_id, "gpt-4o-mini", response.usage.input_tokens, response.usage.output_tokens,
+                         time.monotonic() - started)
         image_data = [
             output.result
             for output in response.output
             if output.type == "image_generation_call"
         ]
-        photos = []
-        for image in image_data:
-            image_base64 = image
-            file_path = f"{get_random_id()}.png"
-            with open(file_path, "wb") as f:
-                f.write(base64.b64decode(image_base64))
-            try:
-                photo_url = await upload_image_to_imgbb(file_path)
-            except Exception:
-                continue
-            if photo_url:
-                photos.append(photo_url)
-            try:
-                os.remove(file_path)
-            except Exception:
-                ...
-        return photos
+        # Декодируем параллельно и вне event loop'а: каждая картинка — несколько мегабайт base64
+        return list(await asyncio.gather(*(asyncio.to_thread(base64.b64decode, image) for image in image_data)))
 
     except Exception as e:
-        raise Exception(f"Ошибка при генерации изображения: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Ошибка при генерации изображения: {str(e)}")
+
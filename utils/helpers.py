@@ -1,15 +1,24 @@
 # utils/helpers.py
+import asyncio
 import base64
+import hashlib
 import mimetypes
 import logging
-import os
+import io
+import tempfile
+from dataclasses import dataclass
+from typing import BinaryIO
 
 import aiohttp
 import requests
 from aiogram import Bot, types
 
 import config
-from data.constants import DURATION_PRICES
+from services.http_client import HTTPClientPool
+from data.constants import DURATION_PRICES, IMAGE_UPLOAD_CONCURRENCY, IMAGE_UPLOAD_TIMEOUT, IMAGE_SPOOL_MAX_MEMORY, \
+    MODEL_IMAGE_LIMITS, DEFAULT_IMAGE_LIMITS, IMGBB_EXPIRATION, IMGBB_UPLOAD_URL
+from services.upload_cache import UploadCache
+from utils.images import normalize_image, IMAGE_EXTENSIONS
 
 
 def calculate_generation_cost(model: str, duration: str, pixverse_mode: str = None,
@@ -39,136 +48,222 @@ def download_video(url: str, filename: str) -> str:
             f.write(chunk)
     return filename
 
+def _ensure_off_event_loop(operation: str) -> None:
+    """Падает, если блокирующая операция вызвана прямо в потоке event loop'а."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raise RuntimeError(f"{operation} блокирует event loop, вызывайте через asyncio.to_thread")
+
+
 def _image_to_data_uri(file_path: str) -> str:
-    """Кодирует изображение из файла в формат Data URI (base64)."""
+    """
+    Кодирует изображение из файла в формат Data URI (base64).
+    Файл читается и кодируется кусками, поэтому в памяти не лежит одновременно весь файл и его base64.
+    Блокирующая функция: из асинхронного кода используйте image_to_data_uri.
+    """
+    _ensure_off_event_loop("Кодирование изображения в base64")
     mime_type, _ = mimetypes.guess_type(file_path)
     if not mime_type or not mime_type.startswith('image'):
         raise ValueError("Не удалось определить MIME-тип изображения или файл не является изображением.")
+    parts = [f"data:{mime_type};base64,"]
     with open(file_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-    return f"data:{mime_type};base64,{encoded_string}"
+        # Размер куска кратен 3, чтобы base64 кусков склеивался без паддинга в середине
+        for chunk in iter(lambda: image_file.read(3 * 256 * 1024), b''):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return ''.join(parts)
+
+
+async def image_to_data_uri(file_path: str) -> str:
+    """Кодирует изображение в Data URI в отдельном потоке, не блокируя обработку других апдейтов."""
+    return await asyncio.to_thread(_image_to_data_uri, file_path)
 
-async def check_user_op_single(bot: Bot, target_chat_id: str, user_id: int) -> bool:
-    async with aiohttp.ClientSession() as session:
-        if ':' in target_chat_id:
+async def check_user_op_single(http: HTTPClientPool, bot: Bot, target_chat_id: str, user_id: int) -> bool:
+    if ':' in target_chat_id:
 
-            api_url = f"https://api.telegram.org/bot{target_chat_id}/getChatMember"
+        api_url = f"https://api.telegram.org/bot{target_chat_id}/getChatMember"
+        payload = {
+            "chat_id": user_id,
+            "user_id": user_id
+        }
+        async with http.session('telegram').post(api_url, data=payload) as resp:
+            data = await resp.json()
+
+        status = data["ok"]
+        if not status:
+            return False
+
+    else:
+
+        member = await bot.get_chat_member(target_chat_id, user_id)
+        if member.status == 'left':
+            return False
+
+    return True
+
+async def check_user_op(http: HTTPClientPool, db, bot: Bot, user_id: int):
+    all_op = await db.subscription.get_all_channels()
+    if not all_op:
+        return None
+    channels = []
+    session = http.session('telegram')
+    for pare in all_op:
+        if ':' in pare.chat_id:
+            api_url = f"https://api.telegram.org/bot{pare.chat_id}/getChatMember"
             payload = {
                 "chat_id": user_id,
                 "user_id": user_id
             }
-            async with session.post(api_url, data=payload, ssl=False) as resp:
+            async with session.post(api_url, data=payload) as resp:
                 data = await resp.json()
 
             status = data["ok"]
             if not status:
-                return False
+                channels.append([pare.id, pare.link_channel])
 
         else:
 
-            member = await bot.get_chat_member(target_chat_id, user_id)
+            member = await bot.get_chat_member(pare.chat_id, user_id)
             if member.status == 'left':
-                return False
-
-    return True
-
-async def check_user_op(db, bot: Bot, user_id: int):
-    all_op = await db.subscription.get_all_channels()
-    if not all_op:
-        return None
-    channels = []
-    async with aiohttp.ClientSession() as session:
-        for pare in all_op:
-            if ':' in pare.chat_id:
-                api_url = f"https://api.telegram.org/bot{pare.chat_id}/getChatMember"
-                payload = {
-                    "chat_id": user_id,
-                    "user_id": user_id
-                }
-                async with session.post(api_url, data=payload, ssl=False) as resp:
-                    data = await resp.json()
-
-                status = data["ok"]
-                if not status:
-                    channels.append([pare.id, pare.link_channel])
-
-            else:
-
-                member = await bot.get_chat_member(pare.chat_id, user_id)
-                if member.status == 'left':
-                    channels.append([pare.id, pare.link_channel])
+                channels.append([pare.id, pare.link_channel])
     if channels:
         return channels
 
     return None
 
 
-async def upload_image_to_imgbb(image_path: str) -> str | None:
-    """Загружает локальный файл на ImgBB и возвращает URL."""
+async def upload_image_to_imgbb(http: HTTPClientPool, image: bytes | BinaryIO, filename: str = 'image.jpg') -> str | None:
+    """
+    Загружает изображение на ImgBB и возвращает URL.
+    Файл уходит multipart-запросом как есть, без кодирования в base64; файловый объект читается потоково.
+    """
     if not config.IMGBB_API_KEY:
         logging.error("Ключ API для ImgBB не найден в конфигурации.")
         return None
 
-    with open(image_path, 'rb') as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-
-    data = {
-        'key': config.IMGBB_API_KEY,
-        'image': encoded_image,
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post("https://api.imgbb.com/1/upload", data=data, ssl=False) as response:
-            if response.status == 200:
+    data = aiohttp.FormData()
+    data.add_field('key', config.IMGBB_API_KEY)
+    data.add_field('expiration', str(IMGBB_EXPIRATION))
+    data.add_field('image', image, filename=filename,
+                   content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+    async with http.session('imgbb').post(IMGBB_UPLOAD_URL, data=data) as response:
+        if response.status == 200:
+            response_data = await response.json()
+            image_url = response_data['data']['url']
+            logging.info(f"Изображение успешно загружено на ImgBB: {image_url}")
+            return image_url
+        else:
+            try:
                 response_data = await response.json()
-                image_url = response_data['data']['url']
-                logging.info(f"Изображение успешно загружено на ImgBB: {image_url}")
-                return image_url
-            else:
-                try:
-                    response_data = await response.json()
-                    logging.error(f"Ошибка загрузки на ImgBB: {response_data}")
-                except aiohttp.ContentTypeError:
-                    logging.error(f"Ошибка загрузки на ImgBB: {response.status} {await response.text()}")
-                return None
+                logging.error(f"Ошибка загрузки на ImgBB: {response_data}")
+            except aiohttp.ContentTypeError:
+                logging.error(f"Ошибка загрузки на ImgBB: {response.status} {await response.text()}")
+            return None
 
 
-async def download_and_upload_images(
-        bot: Bot,
-        album: list[types.Message]
-) -> list[str]:
-    """
-    Скачивает фото из Telegram, загружает их на ImgBB и возвращает список URL.
-    Работает только со списком сообщений (album).
-    """
-    urls = []
+@dataclass(frozen=True)
+class UploadedImage:
+    url: str
+    content_hash: str  # sha256 содержимого, не зависит от того, куда и сколько раз фото загружали
 
-    # Убираем лишнюю логику, работаем только с album
-    messages_to_process = album
 
-    if len(messages_to_process) > 10:
-        raise ValueError("Можно отправить не более 10 фотографий в одном запросе.")
+@dataclass
+class AlbumUpload:
+    images: list[UploadedImage]  # В порядке фото в альбоме
+    failed: list[int]  # Номера фото (с 1), которые не удалось загрузить
 
-    for msg in messages_to_process:
-        # Пропускаем сообщения без фото (например, если в альбоме был текст)
-        if not msg.photo:
-            continue
 
-        photo_obj = msg.photo[-1]
-        temp_photo_path = f"temp_{photo_obj.file_unique_id}.jpg"
+def _image_buffer(size: int | None) -> BinaryIO:
+    """
+    Буфер под скачиваемое фото: небольшие держим в памяти, крупные — в безымянном временном файле,
+    который ОС удалит сама даже при падении процесса.
+    """
+    if size is not None and size <= IMAGE_SPOOL_MAX_MEMORY:
+        return io.BytesIO()
+    return tempfile.TemporaryFile()
+
+
+async def _prepare_photo(buffer: BinaryIO, limits: dict, aspect_ratio: str | None) -> tuple[bytes, str]:
+    """Пережимает фото под модель в отдельном потоке. Если Pillow не справился, отправляем оригинал."""
+    image_format = limits['format']
+    try:
+        data = await asyncio.to_thread(
+            normalize_image, buffer, limits['max_side'], image_format, limits['quality'],
+            aspect_ratio if limits['crop'] else None
+        )
+        return data, IMAGE_EXTENSIONS[image_format]
+    except Exception as e:
+        logging.warning(f"Не удалось подготовить фото, отправляем оригинал: {e}")
+        buffer.seek(0)
+        return buffer.read(), 'jpg'
+
+
+async def _download_and_upload_photo(http: HTTPClientPool, bot: Bot, photo_obj: types.PhotoSize, limits: dict,
+                                     aspect_ratio: str | None,
+                                     upload_cache: UploadCache | None = None) -> UploadedImage | None:
+    crop_aspect = aspect_ratio if limits['crop'] else None
+    # То же фото, подготовленное по тем же правилам, дает ту же картинку — ее можно не загружать заново
+    profile = f"{limits['format']}:{limits['max_side']}:{limits['quality']}:{crop_aspect or ''}"
+    file_key = UploadCache.file_key(photo_obj.file_unique_id, profile)
+    if upload_cache and (cached := await upload_cache.get(file_key)):
+        return UploadedImage(cached.url, cached.content_hash)
+
+    with _image_buffer(photo_obj.file_size) as buffer:
+        await bot.download(file=photo_obj.file_id, destination=buffer)
+        data, extension = await _prepare_photo(buffer, limits, crop_aspect)
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    if upload_cache and (cached := await upload_cache.get(UploadCache.hash_key(content_hash))):
+        await upload_cache.put([file_key], cached.url, content_hash)
+        return UploadedImage(cached.url, content_hash)
+
+    image_url = await upload_image_to_imgbb(http, data, f"{photo_obj.file_unique_id}.{extension}")
+    if not image_url:
+        logging.warning(f"Не удалось загрузить на ImgBB фото: {photo_obj.file_unique_id}")
+        return None
+    if upload_cache:
+        await upload_cache.put([file_key, UploadCache.hash_key(content_hash)], image_url, content_hash)
+    return UploadedImage(image_url, content_hash)
 
-        try:
-            await bot.download(file=photo_obj.file_id, destination=temp_photo_path)
 
-            image_url = await upload_image_to_imgbb(temp_photo_path)
-            if image_url:
-                urls.append(image_url)
-            else:
-                logging.warning(f"Не удалось загрузить на ImgBB файл: {temp_photo_path}")
+async def download_and_upload_images(
+        http: HTTPClientPool,
+        bot: Bot,
+        album: list[types.Message],
+        model_key: str | None = None,
+        aspect_ratio: str | None = None,
+        upload_cache: UploadCache | None = None
+) -> AlbumUpload:
+    """
+    Скачивает фото из Telegram, готовит их под модель (MODEL_IMAGE_LIMITS) и загружает на ImgBB.
+    Фото, которые уже загружались, берутся из upload_cache без скачивания.
+    Фото обрабатываются параллельно (не более IMAGE_UPLOAD_CONCURRENCY одновременно), порядок сохраняется.
+    Фото, которое не удалось загрузить за IMAGE_UPLOAD_TIMEOUT, попадает в failed, остальные загружаются.
+    """
+    # Пропускаем сообщения без фото (например, если в альбоме был текст)
+    photos = [msg.photo[-1] for msg in album if msg.photo]
 
-        finally:
-            if os.path.exists(temp_photo_path):
-                os.remove(temp_photo_path)
+    if len(photos) > 10:
+        raise ValueError("Можно отправить не более 10 фотографий в одном запросе.")
 
-    # Если в итоге ни одной картинки не загрузилось, вернется пустой список
-    return urls
\ No newline at end of file
+    limits = MODEL_IMAGE_LIMITS.get(model_key, DEFAULT_IMAGE_LIMITS)
+    semaphore = asyncio.Semaphore(IMAGE_UPLOAD_CONCURRENCY)
+
+    async def process(photo_obj: types.PhotoSize) -> UploadedImage | None:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(_download_and_upload_photo(http, bot, photo_obj, limits, aspect_ratio, upload_cache),
+                                              timeout=IMAGE_UPLOAD_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f"Тайм-аут загрузки фото {photo_obj.file_unique_id}")
+            except Exception as e:
+                logging.error(f"Ошибка загрузки фото {photo_obj.file_unique_id}: {e}")
+            return None
+
+    results = await asyncio.gather(*(process(photo_obj) for photo_obj in photos))
+    return AlbumUpload(
+        images=[image for image in results if image is not None],
+        failed=[number for number, image in enumerate(results, start=1) if image is None],
+    )
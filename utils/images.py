@@ -0,0 +1,47 @@
+# utils/images.py
+import io
+from typing import BinaryIO
+
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+def _crop_to_aspect(image: Image.Image, aspect_ratio: str) -> Image.Image:
+    """Обрезает изображение по центру под соотношение сторон вида '16:9'."""
+    try:
+        ratio_w, ratio_h = (int(part) for part in aspect_ratio.split(':'))
+    except ValueError:
+        return image
+    width, height = image.size
+    target = ratio_w / ratio_h
+    if abs(width / height - target) < 0.01:
+        return image
+    if width / height > target:
+        new_width = round(height * target)
+        left = (width - new_width) // 2
+        return image.crop((left, 0, left + new_width, height))
+    new_height = round(width / target)
+    top = (height - new_height) // 2
+    return image.crop((0, top, width, top + new_height))
+
+
+def normalize_image(source: BinaryIO, max_side: int, image_format: str = 'JPEG', quality: int = 90,
+                    aspect_ratio: str | None = None) -> bytes:
+    """
+    Готовит фото к отправке провайдеру: поворачивает по EXIF, обрезает под соотношение сторон,
+    уменьшает до max_side по большей стороне и пережимает. EXIF в результат не попадает.
+    Работа синхронная и нагружает CPU — вызывать через asyncio.to_thread.
+    """
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if aspect_ratio:
+            image = _crop_to_aspect(image, aspect_ratio)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode != 'RGB' and not (image_format != 'JPEG' and image.mode == 'RGBA'):
+            image = image.convert('RGB')
+        image.info.pop('exif', None)
+
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True)
+        return output.getvalue()
@@ -0,0 +1,103 @@
+# utils/streaming.py
+import asyncio
+import html
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message, InlineKeyboardMarkup
+
+from data.constants import GPT_STREAM_EDIT_INTERVAL, TELEGRAM_MESSAGE_LIMIT
+
+
+def split_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """
+    Режет текст на части, каждая из которых после html.escape помещается в одно сообщение.
+    Режем по переводу строки или пробелу, чтобы не рвать слова и HTML-сущности.
+    """
+    pages = []
+    while text:
+        escaped_length = 0
+        cut = len(text)
+        for index, char in enumerate(text):
+            escaped_length += len(html.escape(char, quote=False))
+            if escaped_length > limit:
+                cut = index
+                break
+        if cut < len(text):
+            boundary = max(text.rfind('\n', 0, cut), text.rfind(' ', 0, cut))
+            if boundary > cut // 2:
+                cut = boundary + 1
+        pages.append(text[:cut])
+        text = text[cut:]
+    return pages
+
+
+class StreamingMessage:
+    """
+    Выводит растущий ответ в Telegram: редактирует сообщение не чаще interval секунд,
+    а когда текст перестает помещаться в одно сообщение, продолжает в следующем.
+    Клавиатура ставится на последнее сообщение в конце.
+    """
+
+    def __init__(self, placeholder: Message, reply_markup: InlineKeyboardMarkup | None = None,
+                 interval: float = GPT_STREAM_EDIT_INTERVAL, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.messages = [placeholder]
+        self.reply_markup = reply_markup
+        self.interval = interval
+        self.limit = limit
+        self.text = ''
+        self._rendered: list[str | None] = [None]
+        self._last_flush = 0.0
+
+    async def feed(self, delta: str) -> None:
+        self.text += delta
+        if time.monotonic() - self._last_flush >= self.interval:
+            await self._flush(final=False)
+
+    async def finish(self, text: str | None = None) -> None:
+        if text is not None:
+            self.text = text
+        await self._flush(final=True)
+
+    async def _flush(self, final: bool) -> None:
+        self._last_flush = time.monotonic()
+        pages = [html.escape(page, quote=False) for page in split_text(self.text, self.limit)]
+        for index, page in enumerate(pages):
+            markup = self.reply_markup if final and index == len(pages) - 1 else None
+            if index < len(self._rendered) and page == self._rendered[index] and markup is None:
+                continue
+            if index < len(self.messages):
+                if await self._call(self.messages[index].edit_text, page, markup, final) is not None:
+                    self._rendered[index] = page
+            else:
+                sent = await self._call(self.messages[-1].answer, page, markup, final)
+                if sent is None:
+                    return
+                self.messages.append(sent)
+                self._rendered.append(page)
+        if final:
+            # Итоговый текст короче промежуточного: лишние сообщения с устаревшими кусками удаляем
+            while len(self.messages) > max(len(pages), 1):
+                message = self.messages.pop()
+                self._rendered.pop()
+                try:
+                    await message.delete()
+                except Exception as e:
+                    logging.debug(f"Не удалось удалить лишнее сообщение с ответом: {e}")
+
+    @staticmethod
+    async def _call(method, text: str, markup: InlineKeyboardMarkup | None, final: bool):
+        """Промежуточные правки можно пропустить, финальную при флуд-контроле повторяем."""
+        for _ in range(3):
+            try:
+                return await method(text, reply_markup=markup, parse_mode='HTML')
+            except TelegramRetryAfter as e:
+                if not final:
+                    return None
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                # Например, "message is not modified" — текст не изменился с прошлой правки
+                logging.debug(f"Не удалось обновить сообщение с ответом: {e}")
+                return None
+        return None